@@ -1,10 +1,12 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model, authenticate
+from chats import presence
 
 user=get_user_model()
 class UserSerializer(serializers.ModelSerializer):
     password= serializers.CharField(write_only=True)
-    is_online= serializers.BooleanField(read_only=True)
+    # Live presence (chats.presence), not the stored column
+    is_online= serializers.SerializerMethodField()
     last_seen= serializers.DateTimeField(read_only=True)
 
     def create(self,validated_data):
@@ -17,6 +19,9 @@ class UserSerializer(serializers.ModelSerializer):
             description=validated_data.get('description',""),
         )
         return user
+
+    def get_is_online(self, obj):
+        return presence.is_online(obj.id)
     
     class Meta:
         model = get_user_model()
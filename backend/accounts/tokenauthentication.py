@@ -74,7 +74,8 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from datetime import datetime, timedelta
 from django.utils import timezone
-from channels.db import database_sync_to_async
+from chats.db import db_task
+from .tokencache import PRINCIPAL_FIELDS, token_cache, user_version
 import logging
 
 logger = logging.getLogger(__name__)
@@ -82,46 +83,57 @@ User = get_user_model()
 
 class JWTAuthentication(BaseAuthentication):
 
-    @database_sync_to_async
+    @db_task
     def authenticate_websocket(self, scope, token):
         """Authenticate WebSocket connection with JWT token"""
         try:
-            # Decode the token
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-            
-            # Verify token expiration
-            self.verify_token(payload)
-
-            # Get user_id from payload and convert to int safely
-            user_id = payload.get('id')
-            if not user_id:
-                raise AuthenticationFailed("Token missing user ID")
-            
-            # Convert to int if it's a string
-            try:
-                user_id = int(user_id)
-            except (ValueError, TypeError):
-                raise AuthenticationFailed("Invalid user ID format")
-
-            # Get the user
-            user = User.objects.get(id=user_id)
-            
-            # Check if user is active
-            if not user.is_active:
-                raise AuthenticationFailed("User account is inactive")
-                
-            return user
-            
+            return self.get_user(token)
         except InvalidTokenError:
             raise AuthenticationFailed("Invalid token")
         except ExpiredSignatureError:
             raise AuthenticationFailed("Token has expired")
         except User.DoesNotExist:
-            raise AuthenticationFailed(f"User with ID {user_id} not found")
+            raise AuthenticationFailed("User not found")
+        except AuthenticationFailed:
+            raise
         except Exception as e:
             raise AuthenticationFailed(f"Authentication failed: {str(e)}")
-    
-   
+
+    def get_user(self, token):
+        """
+        The active user ``token`` belongs to. Verified tokens are served from
+        the token cache (see accounts.tokencache) without touching the database.
+        """
+        user = token_cache.get(token)
+        if user is not None:
+            return user
+
+        # Decode the token
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+
+        # Verify token expiration
+        self.verify_token(payload)
+
+        # Get user_id from payload and convert to int safely
+        user_id = payload.get('id')
+        if not user_id:
+            raise AuthenticationFailed("Token missing user ID")
+
+        try:
+            user_id = int(user_id)
+        except (ValueError, TypeError):
+            raise AuthenticationFailed("Invalid user ID format")
+
+        # Read before loading the user, so a concurrent change invalidates the entry
+        version = user_version(user_id)
+        user = User.objects.only(*PRINCIPAL_FIELDS).get(id=user_id)
+
+        # Check if user is active
+        if not user.is_active:
+            raise AuthenticationFailed("User account is inactive")
+
+        token_cache.set(token, user, payload['exp'], version)
+        return user
 
     @staticmethod
     def generate_token(payload):
@@ -152,11 +164,6 @@ class JWTAuthentication(BaseAuthentication):
             return None
         
         try:
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-            self.verify_token(payload)
-
-            user_id = payload['id']
-            user = User.objects.get(id=user_id)
-            return (user, token)
+            return (self.get_user(token), token)
         except (InvalidTokenError, ExpiredSignatureError, User.DoesNotExist):
-            raise AuthenticationFailed("Invalid or expired token")
\ No newline at end of file
+            raise AuthenticationFailed("Invalid or expired token")
@@ -0,0 +1,157 @@
+"""
+Verified-token cache shared by JWTAuthentication (REST) and the WebSocket
+middleware.
+
+A verified token maps, by SHA-256 digest, to a lightweight principal: the
+few user columns requests need to know who the caller is. Hits rebuild a
+``User`` from them with every other column deferred (loaded on first
+access and left alone by ``save()``), so an authenticated request does not
+query the database just to authenticate. Entries live until the token's
+``exp`` or ``AUTH_TOKEN_CACHE_TIMEOUT``, whichever is sooner, in a bounded
+per-process LRU of ``AUTH_TOKEN_CACHE_SIZE`` tokens.
+
+Each user has a version in the shared Django cache. Saving (other than
+presence-only updates) or deleting the user bumps it, so every process
+stops using the user's entries at once.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+AUTH_TOKEN_CACHE_SIZE = getattr(settings, "AUTH_TOKEN_CACHE_SIZE", 10000)
+AUTH_TOKEN_CACHE_TIMEOUT = getattr(settings, "AUTH_TOKEN_CACHE_TIMEOUT", 5 * 60)
+
+# Columns kept for the principal; is_online/last_seen change too often to cache
+PRINCIPAL_FIELDS = (
+    'id', 'email', 'first_name', 'last_name', 'image_url', 'description',
+    'is_active', 'is_superuser'
+)
+
+
+def _version_key(user_id):
+    return f"auth:version:{user_id}"
+
+
+def user_version(user_id):
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+class TokenEntry:
+    __slots__ = ("user_id", "version", "expires_at", "values")
+
+    def __init__(self, user_id, version, expires_at, values):
+        self.user_id = user_id
+        self.version = version
+        self.expires_at = expires_at
+        self.values = values
+
+
+class TokenCache:
+
+    def __init__(self, max_size=AUTH_TOKEN_CACHE_SIZE, timeout=AUTH_TOKEN_CACHE_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_user = defaultdict(set)
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode("utf8")).hexdigest()
+
+    def get(self, token):
+        """The cached principal for ``token`` as a ``User``, or None."""
+        digest = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self._remove(digest)
+                return None
+            self._entries.move_to_end(digest)
+
+        if user_version(entry.user_id) != entry.version:
+            with self._lock:
+                self._remove(digest)
+            return None
+
+        User = get_user_model()
+        return User.from_db(User.objects.db, PRINCIPAL_FIELDS, entry.values)
+
+    @staticmethod
+    def _values(user):
+        # from_db() takes the loaded values in concrete field order
+        return tuple(
+            getattr(user, field.attname) for field in user._meta.concrete_fields
+            if field.attname in PRINCIPAL_FIELDS
+        )
+
+    def set(self, token, user, exp, version):
+        """Cache ``user`` for ``token``; ``version`` must be read before ``user`` was loaded."""
+        entry = TokenEntry(
+            user.id, version,
+            min(exp, time.time() + self.timeout),
+            self._values(user)
+        )
+        digest = self.digest(token)
+        with self._lock:
+            self._remove(digest)
+            self._entries[digest] = entry
+            self._by_user[user.id].add(digest)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def discard_user(self, user_id):
+        with self._lock:
+            for digest in list(self._by_user.get(user_id, ())):
+                self._remove(digest)
+
+    def _remove(self, digest):
+        entry = self._entries.pop(digest, None)
+        if entry is None:
+            return
+        digests = self._by_user[entry.user_id]
+        digests.discard(digest)
+        if not digests:
+            del self._by_user[entry.user_id]
+
+
+token_cache = TokenCache()
+
+
+def invalidate_user(user_id):
+    """Drop ``user_id``'s cached tokens here now and in every process on commit."""
+    token_cache.discard_user(user_id)
+    transaction.on_commit(
+        lambda: cache.set(_version_key(user_id), time.time_ns(), timeout=None)
+    )
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        return
+    if update_fields is not None and not set(update_fields) & set(PRINCIPAL_FIELDS):
+        # e.g. presence updates
+        return
+    invalidate_user(instance.id)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_deleted(sender, instance, **kwargs):
+    invalidate_user(instance.id)
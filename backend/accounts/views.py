@@ -18,9 +18,8 @@ def login(request):
     serializer = LoginSerializer(data=request.data)
     if serializer.is_valid():
         user=serializer.context['user']
-        user.is_online=True
         user.last_seen=timezone.now()
-        user.save(update_fields=['is_online','last_seen'])
+        user.save(update_fields=['last_seen'])
         token = JWTAuthentication.generate_token(payload=serializer.data)
 
         return Response({
@@ -57,11 +56,8 @@ class UserDetailView(generics.RetrieveUpdateDestroyAPIView):
                 raise PermissionDenied("You do not have permission to access this user's details.")
         else:
             user = self.request.user
-        
-        user.is_online = True
-        user.last_seen = timezone.now()
-        user.save(update_fields=['is_online', 'last_seen'])
-        
+
+        # Presence comes from the socket (chats.presence), not from reads
         return user
 
 
@@ -91,14 +91,119 @@ REST_FRAMEWORK = {
 
 ASGI_APPLICATION ="backend.asgi.application"
 
-CHANNEL_LAYERS={
-    "default":{
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG":{
-            "hosts":[("127.0.0.1", 6379)], # Redis server address and port( default is 6379)
-        },
+# Single-process deployments (one ASGI worker, no Redis) set this to True
+# to deliver group messages in memory (see chats.layers.LocalChannelLayer)
+CHAT_SINGLE_NODE = False
+
+if CHAT_SINGLE_NODE:
+    CHANNEL_LAYERS={
+        "default":{
+            "BACKEND": "chats.layers.LocalChannelLayer",
+            "CONFIG":{
+                "capacity": 100, # Queued events per socket before group events are dropped
+                "expiry": 60,
+                "group_expiry": 86400,
+            },
+        }
+    }
+else:
+    # Sockets join groups through a per-node channel (see chats.layers), so
+    # each event crosses Redis once per node rather than once per socket.
+    # Groups are consistent-hashed over "hosts": append hosts to scale out,
+    # then run "manage.py rebalance_channel_layer"
+    CHANNEL_LAYERS={
+        "default":{
+            "BACKEND": "chats.layers.NodeFanoutChannelLayer",
+            "CONFIG":{
+                "inner":{
+                    "BACKEND": "chats.layers.ShardedRedisChannelLayer",
+                    "CONFIG":{
+                        "hosts":[("127.0.0.1", 6379)], # Redis server address and port( default is 6379)
+                    },
+                },
+            },
+        }
     }
+
+# Shared cache (membership checks and other cross-process state)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/1",
+    }
+}
+
+# Verified JWTs cached per process (by digest) so authenticated requests
+# skip the user lookup: most tokens kept, and the longest an entry lives
+# (seconds; never past the token's own expiry)
+AUTH_TOKEN_CACHE_SIZE = 10000
+AUTH_TOKEN_CACHE_TIMEOUT = 5 * 60
+
+# How long a cached "is user X in conversation Y" answer lives (seconds)
+CHAT_MEMBERSHIP_CACHE_TIMEOUT = 60 * 60
+
+# How long a cached per-user total unread count lives (seconds); writes
+# invalidate it, the timeout only bounds staleness after a lost invalidation
+CHAT_UNREAD_CACHE_TIMEOUT = 5 * 60
+
+# Group-commit writer for WebSocket messages: how long to wait for more
+# messages before committing a batch (seconds), and the largest batch size
+CHAT_WRITE_BATCH_WINDOW = 0.005
+CHAT_WRITE_BATCH_MAX_SIZE = 200
+
+# Outbox relay of message events to sockets: events per batch, how often
+# to look for events committed by other processes (seconds), and how long
+# a claimed batch may stay unsent before another dispatcher retries it
+CHAT_OUTBOX_BATCH_SIZE = 500
+CHAT_OUTBOX_POLL_INTERVAL = 1.0
+CHAT_OUTBOX_CLAIM_TIMEOUT = 30
+
+# Most messages replayed to a reconnecting socket; beyond this the client
+# is told to reload the latest REST page instead
+CHAT_RESUME_MAX_MESSAGES = 200
+
+# Newest messages included in the connect-time snapshot frame (?snapshot=1)
+CHAT_SNAPSHOT_MESSAGES = 50
+
+# Typing indicators: how often coalesced typing state is sent (seconds),
+# and how long a typist stays "typing" without another typing_start
+CHAT_TYPING_INTERVAL = 0.5
+CHAT_TYPING_TIMEOUT = 5.0
+
+# Read receipts are merged per conversation and broadcast once per window (seconds)
+CHAT_RECEIPT_INTERVAL = 0.5
+
+# Presence (kept in the cache above): how often each process refreshes its
+# users, reaps silent sockets and saves last_seen (seconds), and how long a
+# user stays online without a refresh, or a heartbeating socket may stay
+# silent, before it is dropped
+CHAT_PRESENCE_INTERVAL = 20.0
+CHAT_PRESENCE_TIMEOUT = 60.0
+
+# Token buckets per client event (shared by sockets and the REST message
+# endpoints): per user and/or per conversation, (tokens per second, burst).
+# "subscription" covers inbox subscribe/unsubscribe frames. "local" keeps
+# buckets per process; "cache" shares them via the cache above
+CHAT_RATE_LIMITS = {
+    "new_message": {"user": (5, 20), "conversation": (50, 200)},
+    "typing_start": {"user": (2, 10)},
+    "mark_read": {"user": (10, 30)},
+    "subscription": {"user": (2, 20)},
 }
+CHAT_RATE_LIMIT_BACKEND = "local"
+# Rate-limited frames in a row after which a socket is closed (4008)
+CHAT_RATE_LIMIT_MAX_REJECTIONS = 50
+
+# Frames queued per socket for a slow client; when full, typing frames are
+# dropped, then read receipts merged, then the socket is closed (4009) with
+# a resume hint (see chats.outbound)
+CHAT_SEND_QUEUE_SIZE = 256
+
+# Threads that run socket database work (handshakes, context loads, reads,
+# mark-read, message batches) instead of the single shared sync thread;
+# also the most queries sockets can have in flight per process (always 1
+# on SQLite, which has a single writer)
+CHAT_DB_CONCURRENCY = 8
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -107,6 +212,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # One writer at a time: wait up to 20s for the write lock. Writing
+        # transactions take it when they start (chats.db.write_transaction);
+        # the rest stay deferred, so reads do not queue behind writers
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
@@ -22,6 +22,9 @@ urlpatterns = [
     path('api/chats/',views.get_chats,name='chat-list'),
     path('api/chats/unread/',views.unread_count,name='unread-count'),
 
+    # Inbox (direct and group conversations in one list)
+    path('api/inbox/',views.inbox,name='inbox'),
+
     # Direct Conversation 
     path('api/conversations/<int:user_id>/',views.get_or_create_conversation,name='get-or-create-conversation'),
     path('api/conversations/<int:conversation_id>/messages/',views.get_conversation_messages_direct,name='conversation-messages'),
@@ -44,6 +47,10 @@ urlpatterns = [
     path("api/groups/<int:conversation_id>/messages/",views.get_group_message,name='get-group-messages'),
     path("api/groups/<int:conversation_id>/send/",views.send_group_message,name='send-group-message'),
     path("api/groups/messages/<int:message_id>/delete/",views.delete_group_message,name='delete-group-message'),
-    path('api/groups/<int:conversation_id>/read/',views.mark_group_read,name='mark-group-read')
+    path("api/groups/messages/<int:message_id>/readers/",views.get_group_message_readers,name='group-message-readers'),
+    path('api/groups/<int:conversation_id>/read/',views.mark_group_read,name='mark-group-read'),
+
+    # Realtime metrics (admin only)
+    path('api/metrics/',views.metrics_snapshot,name='metrics')
 
 ]
\ No newline at end of file
@@ -1,14 +1,28 @@
 import json
 import logging
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
-from .models import Conversation, Message, PersonalMessage
+from .models import Conversation, Message
+from .db import db_task, write_transaction
+from .context import conversation_group_name, user_group_name, load_conversation_contexts
+from .updates import push_inbox_updates
+from .outbox import get_outbox_dispatcher
+from . import replay, ratelimit, outbound
+from .snapshot import build_snapshot
+from .typing import get_typing_coalescer
+from .presence import get_presence_tracker
+from .read_receipts import (
+    RECEIPTS_IDS, RECEIPTS_NONE, RECEIPT_GRANULARITIES, get_receipt_coalescer
+)
+from .writer import get_message_writer
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
+HEARTBEAT_FRAME = json.dumps({"type": "heartbeat"})
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
 
@@ -25,11 +39,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 self.scope["url_route"]["kwargs"]["conversation_id"]
             )
 
-            self.room_group_name = f"chat_{self.conversation_id}"
+            self.room_group_name = conversation_group_name(self.conversation_id)
+            self.sender_name = self.user.get_full_name() or self.user.email
 
-            # Verify user belongs to conversation
-            is_allowed = await self.is_user_allowed()
-            if not is_allowed:
+            # Load the conversation context once; it also verifies membership
+            self.contexts = await self.load_contexts([self.conversation_id])
+            if self.conversation_id not in self.contexts:
                 logger.warning(f"User {self.user.id} not allowed in conversation {self.conversation_id}")
                 await self.close(code=4003)
                 return
@@ -38,9 +53,28 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 self.room_group_name,
                 self.channel_name
             )
+            await self.channel_layer.group_add(
+                user_group_name(self.user.id),
+                self.channel_name
+            )
+            get_outbox_dispatcher()
 
             await self.accept()
+            await get_presence_tracker().connect(self)
             logger.info(f"User {self.user.id} connected to conversation {self.conversation_id}")
+
+            query_params = parse_qs(self.scope.get("query_string", b"").decode())
+            self.receipt_granularity = self.receipt_granularity_from(query_params)
+
+            # Everything needed to render the chat in one frame (?snapshot=1)
+            if query_params.get("snapshot", [""])[0].lower() in ("1", "true"):
+                snapshot = await self.load_snapshot(self.contexts[self.conversation_id])
+                await self.send(text_data=json.dumps(snapshot))
+
+            # Reconnecting clients pass the newest seq they saw (?last_seq=)
+            cursor = replay.parse_cursor({key: values[0] for key, values in query_params.items()})
+            if cursor:
+                await self.resume(self.conversation_id, cursor)
         except Exception as e:
             logger.error(f"Error in WebSocket connect: {str(e)}")
             await self.close(code=4000)
@@ -48,10 +82,17 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         try:
+            self.stop_sending()
+            get_presence_tracker().disconnect(self)
+            self.stop_typing()
             await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
+            await self.channel_layer.group_discard(
+                user_group_name(self.user.id),
+                self.channel_name
+            )
             logger.info(f"User {self.user.id} disconnected from conversation {self.conversation_id}")
         except Exception as e:
             logger.error(f"Error in WebSocket disconnect: {str(e)}")
@@ -64,215 +105,413 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send(text_data=json.dumps({"error": "Invalid JSON format"}))
             return
 
+        get_presence_tracker().touch(self)
+        if data.get("type") == "heartbeat":
+            await self.heartbeat()
+            return
+
+        if data.get("type") == "receipts":
+            await self.set_receipt_granularity(data.get("granularity"))
+            return
+
+        await self.handle_event(self.conversation_id, data)
+
+    async def heartbeat(self):
+        """
+        Client keep-alive ({"type": "heartbeat"}, answered in kind). Once a
+        socket has sent one, going silent for CHAT_PRESENCE_TIMEOUT closes
+        it (see chats.presence).
+        """
+        self.heartbeats = True
+        await self.send(text_data=HEARTBEAT_FRAME)
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        # Rate-limited frames in a row (see rate_limited)
+        self.rejections = 0
+        self.outbound = outbound.SendQueue(
+            super().send, self.close, self.user.id, self.channel_name
+        )
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """Replies are queued like group events, so they keep their order."""
+        if text_data is None or close:
+            await super().send(text_data, bytes_data, close)
+            return
+        await self.send_frame(text_data)
+
+    async def send_frame(self, frame, kind=outbound.FRAME, key=None):
+        """Queue an encoded frame; ``kind`` decides what is given up first on a slow socket."""
+        if getattr(self, "outbound", None) is None:
+            await super().send(text_data=frame)
+            return
+        self.outbound.put(frame, kind, key)
+
+    def stop_sending(self):
+        if getattr(self, "outbound", None) is not None:
+            self.outbound.stop()
+
+    async def rate_limited(self, event_type, conversation_id=None):
+        """
+        Take a token for ``event_type``. Returns True if the frame must be
+        dropped, after telling the client when to retry; a client that keeps
+        sending regardless is disconnected with code 4008.
+        """
+        wait = await ratelimit.take_async(event_type, self.user.id, conversation_id)
+        if wait is None:
+            self.rejections = 0
+            return False
+
+        self.rejections += 1
+        if self.rejections > ratelimit.MAX_REJECTIONS:
+            logger.warning(f"Closing socket of user {self.user.id}: rate limit ignored")
+            await self.close(code=ratelimit.CLOSE_CODE)
+            return True
+
+        frame = {"error": "Rate limit exceeded", "event": event_type}
+        if conversation_id is not None:
+            frame["conversation_id"] = conversation_id
+        frame["retry_after"] = round(wait, 3)
+        await self.send(text_data=json.dumps(frame))
+        return True
+
+    async def handle_event(self, conversation_id, data):
+        """Handle a client frame addressed to ``conversation_id``."""
+        context = self.contexts[conversation_id]
         try:
             event_type = data.get("type")
 
+            if await self.rate_limited(event_type, conversation_id):
+                return
+
             # Message Event
             if event_type == "new_message":
                 message_text = data.get("message", "").strip()
                 if not message_text:
                     return
 
-                message_obj = await self.save_message(message_text)
-                if not message_obj:
-                    return
-
-                # Get sender info
-                sender_name = await self.get_sender_name()
-
-                # message content may be in .text (Message) or .message (PersonalMessage)
-                out_message = getattr(message_obj, 'text', None) or getattr(message_obj, 'message', '')
-                out_timestamp = getattr(message_obj, 'timestamp', None)
-
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "chat_message",
-                        "message_id": message_obj.id,
-                        "message": out_message,
-                        "sender_id": self.user.id,
-                        "sender_name": sender_name,
-                        "timestamp": str(out_timestamp),
-                        "conversation_id": self.conversation_id
-                    }
-                )
-
-            # Typing Start
+                # The chat_message event is relayed from the outbox once the
+                # message commits (see chats.outbox)
+                get_typing_coalescer().stop(conversation_id, self.user.id)
+                if await self.save_message(conversation_id, message_text) is None:
+                    # Nothing will be relayed, so the sender must retry
+                    await self.send(text_data=json.dumps({
+                        "error": "Message could not be saved",
+                        "conversation_id": conversation_id
+                    }))
+
+            # Typing: coalesced per conversation and flushed on an interval
             elif event_type == "typing_start":
-                sender_name = await self.get_sender_name()
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "typing_event",
-                        "status": "start",
-                        "user_id": self.user.id,
-                        "user_name": sender_name
-                    }
-                )
+                get_typing_coalescer().start(conversation_id, self.user.id, self.sender_name)
 
-            # Typing Stop
             elif event_type == "typing_stop":
-                sender_name = await self.get_sender_name()
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "typing_event",
-                        "status": "stop",
-                        "user_id": self.user.id,
-                        "user_name": sender_name
-                    }
-                )
+                get_typing_coalescer().stop(conversation_id, self.user.id)
 
             # Mark as read
             elif event_type == "mark_read":
-                message_ids = data.get("message_ids", [])
+                try:
+                    message_ids = {int(message_id) for message_id in data.get("message_ids", [])}
+                except (TypeError, ValueError):
+                    await self.send(text_data=json.dumps({"error": "message_ids must be a list of ids"}))
+                    return
                 if message_ids:
-                    await self.mark_messages_read(message_ids)
-                    
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "read_receipt",
-                            "message_ids": message_ids,
-                            "reader_id": self.user.id,
-                            "reader_name": await self.get_sender_name()
-                        }
-                    )
+                    await self.mark_messages_read(context, message_ids)
+                    await push_inbox_updates([conversation_id], [self.user.id])
+
+                    # Broadcast as part of the conversation's next read_summary
+                    get_receipt_coalescer().add(conversation_id, self.user.id, self.sender_name, message_ids)
+
+            # Replay missed messages after a reconnect
+            elif event_type == "resume":
+                cursor = replay.parse_cursor(data)
+                if cursor is None:
+                    await self.send(text_data=json.dumps({"error": "last_seq or last_message_id is required"}))
+                    return
+                await self.resume(conversation_id, cursor)
         except Exception as e:
             logger.error(f"Error processing WebSocket message: {str(e)}")
             await self.send(text_data=json.dumps({"error": "Error processing message"}))
 
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "new_message",
-            "id": event["message_id"],
-            "message": event["message"],
-            "sender_id": event["sender_id"],
-            "sender_name": event["sender_name"],
-            "timestamp": event["timestamp"],
-            "conversation_id": event["conversation_id"]
-        }))
+    @staticmethod
+    def receipt_granularity_from(query_params):
+        granularity = query_params.get("receipts", [RECEIPTS_IDS])[0]
+        return granularity if granularity in RECEIPT_GRANULARITIES else RECEIPTS_IDS
+
+    async def set_receipt_granularity(self, granularity):
+        """Choose how read receipts are delivered to this socket (ids, summary or none)."""
+        if granularity not in RECEIPT_GRANULARITIES:
+            await self.send(text_data=json.dumps({
+                "error": f"granularity must be one of: {', '.join(RECEIPT_GRANULARITIES)}"
+            }))
+            return
+        self.receipt_granularity = granularity
+        await self.send(text_data=json.dumps({"type": "receipts", "granularity": granularity}))
 
-    async def typing_event(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "typing",
-            "status": event["status"],
-            "user_id": event["user_id"],
-            "user_name": event["user_name"]
-        }))
+    def stop_typing(self):
+        typing = get_typing_coalescer()
+        for conversation_id in getattr(self, "contexts", {}):
+            typing.stop(conversation_id, self.user.id)
 
-    async def read_receipt(self, event):
+    async def resume(self, conversation_id, cursor):
+        """Replay what the client missed after ``cursor``; live events queue meanwhile."""
+        try:
+            frames = await self.load_replay(self.contexts[conversation_id], cursor)
+        except replay.ResumeOverflow:
+            await self.send(text_data=json.dumps({
+                "type": "resync_required",
+                "conversation_id": conversation_id,
+                "reason": "Too many missed messages, reload the latest page"
+            }))
+            return
+        except Message.DoesNotExist:
+            await self.send(text_data=json.dumps({
+                "error": "Unknown resume cursor",
+                "conversation_id": conversation_id
+            }))
+            return
+
+        for frame in frames:
+            if frame["type"] == "messages_read" and self.receipt_granularity == RECEIPTS_NONE:
+                continue
+            if frame["type"] == "new_message":
+                await self.send_frame(
+                    json.dumps(frame), outbound.MESSAGE, (conversation_id, frame["seq"])
+                )
+            else:
+                await self.send(text_data=json.dumps(frame))
         await self.send(text_data=json.dumps({
-            "type": "messages_read",
-            "message_ids": event["message_ids"],
-            "reader_id": event["reader_id"],
-            "reader_name": event["reader_name"]
+            "type": "resumed",
+            "conversation_id": conversation_id,
+            "replayed": sum(1 for frame in frames if frame["type"] == "new_message")
         }))
 
+    # Group events carry their client frame already encoded (see chats.frames)
+
+    async def chat_message(self, event):
+        await self.send_frame(
+            event["frame"], outbound.MESSAGE, (event["conversation_id"], event.get("seq"))
+        )
+
+    async def typing_state(self, event):
+        await self.send_frame(event["frame"], outbound.TYPING)
+
+    async def read_summary(self, event):
+        for frame in event["frames"].get(self.receipt_granularity, ()):
+            await self.send_frame(frame, outbound.RECEIPT)
+
+    async def inbox_update(self, event):
+        await self.send(text_data=event["frame"])
+
+    async def presence_changed(self, event):
+        await self.send(text_data=event["frame"])
+
+    async def membership_changed(self, event):
+        conversation_id = event["conversation_id"]
+        contexts = await self.load_contexts([conversation_id])
+        if conversation_id in contexts:
+            self.contexts[conversation_id] = contexts[conversation_id]
+            return
+        await self.drop_conversation(conversation_id)
+
+    async def drop_conversation(self, conversation_id):
+        """The user lost access to ``conversation_id`` (removed or group deleted)."""
+        logger.info(f"User {self.user.id} no longer in conversation {conversation_id}")
+        self.contexts.pop(conversation_id, None)
+        await self.close(code=4003)
+
     # Database operations
-    @sync_to_async
-    def get_sender_name(self):
-        return self.user.get_full_name() or self.user.email
+    @db_task
+    def load_contexts(self, conversation_ids):
+        return load_conversation_contexts(self.user, conversation_ids)
+
+    @db_task
+    def load_snapshot(self, context):
+        return build_snapshot(context, self.user)
+
+    @db_task
+    def load_replay(self, context, cursor):
+        return replay.load_replay(context, self.user, cursor)
 
-    @sync_to_async
-    def is_user_allowed(self):
+    async def save_message(self, conversation_id, message_text):
+        # Persisted by the group-commit writer together with other in-flight messages
         try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            # Direct conversation: user1 or user2
-            if conversation.conversation_type == 'direct':
-                return self.user in [conversation.user1, conversation.user2]
-            # Group conversation: check participants
-            if conversation.conversation_type == 'group':
-                return conversation.participants.filter(id=self.user.id).exists()
-            return False
-        except Conversation.DoesNotExist:
-            logger.warning(f"Conversation {self.conversation_id} not found")
-            return False
+            return await get_message_writer().submit(self.user, conversation_id, message_text)
         except Exception as e:
-            logger.error(f"Error checking user access: {str(e)}")
-            return False
+            logger.error(f"Error saving message: {str(e)}")
+            return None
 
-    @sync_to_async
-    def save_message(self, message_text):
+    @db_task
+    def mark_messages_read(self, context, message_ids):
         try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-
-            # For direct conversations, use PersonalMessage model
-            if conversation.conversation_type == 'direct':
-                # determine receiver
-                receiver = conversation.user2 if self.user == conversation.user1 else conversation.user1
-                message = PersonalMessage.objects.create(
-                    sender=self.user,
-                    receiver=receiver,
-                    message=message_text
-                )
+            updated = Message.objects.filter(
+                id__in=message_ids,
+                conversation_id=context.conversation_id,
+                is_read=False
+            ).exclude(sender=self.user).update(is_read=True)
+
+            with write_transaction():
+                conversation = Conversation.objects.get(id=context.conversation_id)
+                # Everything up to the newest message counts as read: this
+                # moves the read watermark receipts are answered from and
+                # the user's total unread counter together
+                conversation.advance_read_seq(self.user)
+            return updated
+        except Exception as e:
+            logger.error(f"Error marking messages as read: {str(e)}")
+            return 0
 
-                # Update conversation metadata and unread counts
-                conversation.last_message = message_text
-                conversation.last_message_time = message.timestamp
-                conversation.last_message_sender = self.user
-                conversation.increment_unread_for_receiver(self.user)
-                conversation.save()
-                return message
-
-            # Group message
-            message = Message.objects.create(
-                conversation=conversation,
-                sender=self.user,
-                text=message_text
-            )
 
-            # Update conversation metadata and unread counts for group
-            conversation.last_message = message_text
-            conversation.last_message_time = message.timestamp
-            conversation.last_message_sender = self.user
-            conversation.increment_group_unread_for_all(self.user)
-            conversation.save()
+class InboxConsumer(ChatConsumer):
+    """
+    One socket per user that multiplexes many conversations.
 
-            return message
-        except Conversation.DoesNotExist:
-            logger.error(f"Conversation {self.conversation_id} not found when saving message")
-            return None
+    Clients manage subscriptions in-band:
+        {"type": "subscribe", "conversation_ids": [1, 2, 3]}
+        {"type": "unsubscribe", "conversation_ids": [2]}
+
+    Every other frame uses the ChatConsumer event shapes with an extra
+    ``conversation_id`` key naming the (subscribed) target conversation.
+    """
+
+    async def connect(self):
+        try:
+            self.user = self.scope["user"]
+
+            if not self.user or isinstance(self.user, AnonymousUser):
+                logger.warning("Anonymous user attempted inbox WebSocket connection")
+                await self.close(code=4001)
+                return
+
+            self.sender_name = self.user.get_full_name() or self.user.email
+            # Subscribed conversations, each with its connection-scoped context
+            self.contexts = {}
+
+            query_params = parse_qs(self.scope.get("query_string", b"").decode())
+            self.receipt_granularity = self.receipt_granularity_from(query_params)
+
+            await self.channel_layer.group_add(
+                user_group_name(self.user.id),
+                self.channel_name
+            )
+            get_outbox_dispatcher()
+
+            await self.accept()
+            await get_presence_tracker().connect(self)
+            logger.info(f"User {self.user.id} connected to inbox")
         except Exception as e:
-            logger.error(f"Error saving message: {str(e)}")
-            return None
+            logger.error(f"Error in inbox WebSocket connect: {str(e)}")
+            await self.close(code=4000)
 
-    @sync_to_async
-    def mark_messages_read(self, message_ids):
+    async def disconnect(self, close_code):
         try:
-            # Mark messages as read for the appropriate model depending on conversation type
-            conversation = Conversation.objects.get(id=self.conversation_id)
-
-            if conversation.conversation_type == 'direct':
-                # Direct messages are PersonalMessage instances
-                messages = PersonalMessage.objects.filter(
-                    id__in=message_ids,
-                    receiver=self.user
+            self.stop_sending()
+            get_presence_tracker().disconnect(self)
+            self.stop_typing()
+            for conversation_id in getattr(self, "contexts", {}):
+                await self.channel_layer.group_discard(
+                    conversation_group_name(conversation_id),
+                    self.channel_name
                 )
-                updated = messages.exclude(is_read=True).update(is_read=True)
-
-                # Reset unread count for this user
-                if self.user == conversation.user1:
-                    conversation.unread_count_user1 = 0
-                elif self.user == conversation.user2:
-                    conversation.unread_count_user2 = 0
-                conversation.save()
-                return updated
-
-            # Group messages: add to read_by M2M and set is_read for backward compatibility
-            messages = Message.objects.filter(id__in=message_ids, conversation=conversation).exclude(sender=self.user)
-            for message in messages:
-                message.read_by.add(self.user)
-                if not message.is_read:
-                    message.is_read = True
-                    message.save()
-
-            # Reset group unread for this participant
-            conversation.reset_group_unread_for_user(self.user)
-            return messages.count()
-        except Conversation.DoesNotExist:
-            logger.error(f"Conversation {self.conversation_id} not found when marking messages as read")
-            return 0
+            await self.channel_layer.group_discard(
+                user_group_name(self.user.id),
+                self.channel_name
+            )
+            logger.info(f"User {self.user.id} disconnected from inbox")
         except Exception as e:
-            logger.error(f"Error marking messages as read: {str(e)}")
-            return 0
\ No newline at end of file
+            logger.error(f"Error in inbox WebSocket disconnect: {str(e)}")
+
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            logger.error("Invalid JSON received in inbox WebSocket")
+            await self.send(text_data=json.dumps({"error": "Invalid JSON format"}))
+            return
+
+        get_presence_tracker().touch(self)
+        event_type = data.get("type")
+
+        if event_type == "heartbeat":
+            await self.heartbeat()
+            return
+
+        if event_type in ("subscribe", "unsubscribe"):
+            # Each one joins or leaves channel-layer groups (and subscribing
+            # loads contexts), so both draw from the subscription bucket
+            if await self.rate_limited("subscription"):
+                return
+            if event_type == "subscribe":
+                await self.subscribe(self.parse_conversation_ids(data))
+            else:
+                await self.unsubscribe(self.parse_conversation_ids(data))
+            return
+
+        if event_type == "receipts":
+            await self.set_receipt_granularity(data.get("granularity"))
+            return
+
+        try:
+            conversation_id = int(data.get("conversation_id"))
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({"error": "conversation_id is required"}))
+            return
+
+        if conversation_id not in self.contexts:
+            await self.send(text_data=json.dumps({
+                "error": "Not subscribed to conversation",
+                "conversation_id": conversation_id
+            }))
+            return
+
+        await self.handle_event(conversation_id, data)
+
+    @staticmethod
+    def parse_conversation_ids(data):
+        raw_ids = data.get("conversation_ids")
+        if raw_ids is None:
+            raw_ids = [data.get("conversation_id")]
+
+        conversation_ids = set()
+        for raw_id in raw_ids:
+            try:
+                conversation_ids.add(int(raw_id))
+            except (TypeError, ValueError):
+                continue
+        return conversation_ids
+
+    async def subscribe(self, conversation_ids):
+        requested = conversation_ids - self.contexts.keys()
+        contexts = await self.load_contexts(requested) if requested else {}
+
+        for conversation_id in contexts:
+            await self.channel_layer.group_add(
+                conversation_group_name(conversation_id),
+                self.channel_name
+            )
+        self.contexts.update(contexts)
+
+        await self.send(text_data=json.dumps({
+            "type": "subscribed",
+            "conversation_ids": sorted(conversation_ids & self.contexts.keys()),
+            "denied": sorted(requested - contexts.keys())
+        }))
+
+    async def unsubscribe(self, conversation_ids):
+        removed = conversation_ids & self.contexts.keys()
+
+        for conversation_id in removed:
+            await self.channel_layer.group_discard(
+                conversation_group_name(conversation_id),
+                self.channel_name
+            )
+            del self.contexts[conversation_id]
+
+        await self.send(text_data=json.dumps({
+            "type": "unsubscribed",
+            "conversation_ids": sorted(removed)
+        }))
+
+    async def drop_conversation(self, conversation_id):
+        # Only this subscription goes away; the socket stays open for the others
+        logger.info(f"User {self.user.id} no longer in conversation {conversation_id}")
+        await self.unsubscribe({conversation_id})
@@ -0,0 +1,81 @@
+"""
+Connection-scoped conversation context for WebSocket consumers.
+
+A context is loaded once when a socket joins a conversation and holds what
+every frame needs (conversation type and the other user of a direct chat),
+so ephemeral events never touch the database. Membership itself is checked
+through the shared cache in ``chats.membership``; views that change it call
+``notify_membership_changed`` and the consumers reload their context.
+"""
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from .membership import member_conversation_ids
+from .models import Conversation
+
+
+def conversation_group_name(conversation_id):
+    return f"chat_{conversation_id}"
+
+
+def user_group_name(user_id):
+    """Per-user group every authenticated socket joins (see chats.updates)."""
+    return f"user_{user_id}"
+
+
+class ConversationContext:
+    __slots__ = ("conversation_id", "conversation_type", "user1_id", "user2_id",
+                 "other_user_id")
+
+    def __init__(self, conversation, user_id):
+        self.conversation_id = conversation.id
+        self.conversation_type = conversation.conversation_type
+        self.user1_id = conversation.user1_id
+        self.user2_id = conversation.user2_id
+
+        if conversation.conversation_type == 'direct':
+            self.other_user_id = (
+                conversation.user2_id if user_id == conversation.user1_id
+                else conversation.user1_id
+            )
+        else:
+            self.other_user_id = None
+
+    @property
+    def is_direct(self):
+        return self.conversation_type == 'direct'
+
+
+def load_conversation_contexts(user, conversation_ids):
+    """Load contexts for the conversations ``user`` belongs to, keyed by id."""
+    allowed = member_conversation_ids(user.id, conversation_ids)
+    if not allowed:
+        return {}
+
+    conversations = Conversation.objects.filter(id__in=allowed).only(
+        'id', 'conversation_type', 'user1_id', 'user2_id'
+    )
+    return {
+        conversation.id: ConversationContext(conversation, user.id)
+        for conversation in conversations
+    }
+
+
+def notify_membership_changed(conversation_id):
+    """
+    Tell connected sockets to reload the conversation's context once the
+    current transaction commits, so the reload sees the new membership
+    (and nothing is sent for a change that rolls back).
+    """
+    def send():
+        async_to_sync(get_channel_layer().group_send)(
+            conversation_group_name(conversation_id),
+            {
+                "type": "membership_changed",
+                "conversation_id": conversation_id
+            }
+        )
+
+    transaction.on_commit(send)
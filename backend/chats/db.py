@@ -0,0 +1,111 @@
+"""
+Database access from the realtime path.
+
+``sync_to_async`` runs every call on one thread-sensitive thread per
+process by default, and so does Django's async ORM (``aget``, ``acreate``,
+... wrap the sync ORM in it). Handshakes, context loads and mark-read
+writes from every socket therefore queue behind each other and behind
+sync REST views. Socket database work is made of self-contained calls
+(each one its own transaction), so it runs on a dedicated pool of
+``CHAT_DB_CONCURRENCY`` threads instead. The pool size also bounds the
+queries (and connections) sockets can have in flight. SQLite allows one
+writer at a time, so against it the pool has a single thread and only
+keeps socket work off the thread of the sync REST views: the added
+concurrency needs a database server.
+
+    @db_task
+    def load_contexts(self, conversation_ids):
+        ...
+
+Calls that only touch the cache (presence, cache-backed rate limits) do
+not take a pool thread from the database work; they use
+``sync_to_async(..., thread_sensitive=False)``.
+
+Transactions that write (message batches, read seqs, outbox claims) use
+``write_transaction`` so that, on SQLite, they wait for the write lock
+up front instead of failing with "database is locked" when a read
+transaction has to upgrade while another thread writes.
+"""
+
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+DB_CONCURRENCY = getattr(settings, "CHAT_DB_CONCURRENCY", 8)
+if settings.DATABASES["default"]["ENGINE"] == "django.db.backends.sqlite3":
+    DB_CONCURRENCY = 1
+
+_executor = ThreadPoolExecutor(max_workers=DB_CONCURRENCY, thread_name_prefix="chat-db")
+
+
+def db_task(func):
+    """Like ``database_sync_to_async``, but on the bounded pool."""
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=_executor)
+
+
+def per_loop(factory):
+    """
+    Make ``factory`` return one instance per event loop: the first call on
+    a loop creates it, later calls on that loop return it, and it is
+    dropped with the loop. For the background workers (coalescers, the
+    presence tracker, the outbox dispatcher, the message writer) that
+    must only be driven from their own loop:
+
+        @per_loop
+        def get_typing_coalescer():
+            return TypingCoalescer()
+
+    ``factory.instances()`` lists the live ``(loop, instance)`` pairs and
+    may be called from any thread.
+    """
+    instances = weakref.WeakKeyDictionary()
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get():
+        loop = asyncio.get_running_loop()
+        with lock:
+            instance = instances.get(loop)
+            if instance is None:
+                instance = instances[loop] = factory()
+        return instance
+
+    def live_instances():
+        with lock:
+            return list(instances.items())
+
+    get.instances = live_instances
+    return get
+
+
+@contextmanager
+def write_transaction(using=DEFAULT_DB_ALIAS):
+    """
+    ``transaction.atomic`` for a block that writes. On SQLite the outermost
+    block starts with ``BEGIN IMMEDIATE``, taking the write lock (or waiting
+    up to the connection timeout for it) before its first read. Other
+    transactions stay deferred, so reads never wait for writers.
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite" or connection.in_atomic_block:
+        with transaction.atomic(using=using):
+            yield
+        return
+
+    # Connecting reads transaction_mode from OPTIONS again
+    connection.ensure_connection()
+    mode = connection.transaction_mode
+    connection.transaction_mode = "IMMEDIATE"
+    try:
+        with transaction.atomic(using=using):
+            connection.transaction_mode = mode
+            yield
+    finally:
+        connection.transaction_mode = mode
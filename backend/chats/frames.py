@@ -0,0 +1,40 @@
+"""
+Client frames for group events, encoded once per event.
+
+A group event can reach thousands of sockets on a node. Producers put the
+JSON text of the frame each recipient gets on the event itself, so
+consumers send it as is instead of rebuilding and re-encoding it per
+socket:
+
+    {"type": "typing_state", "conversation_id": 7, "frame": '{"type": ...}'}
+
+Anything that differs per socket cannot go in a shared frame: read
+receipts carry one encoding per granularity, and the socket picks one.
+"""
+
+import json
+
+
+def encode(frame):
+    return json.dumps(frame)
+
+
+def new_message_frame(payload):
+    """The ``new_message`` frame for an outbox ``chat_message`` payload."""
+    return {
+        "type": "new_message",
+        "id": payload["message_id"],
+        "seq": payload.get("seq"),
+        "message": payload["message"],
+        "sender_id": payload["sender_id"],
+        "sender_name": payload["sender_name"],
+        "timestamp": payload["timestamp"],
+        "conversation_id": payload["conversation_id"]
+    }
+
+
+def prepare_outbox_event(payload):
+    """Attach the encoded frame to an outbox payload before it is relayed."""
+    if payload.get("type") == "chat_message" and "frame" not in payload:
+        return {**payload, "frame": encode(new_message_frame(payload))}
+    return payload
@@ -0,0 +1,458 @@
+"""
+Channel layers for the chat app.
+
+NodeFanoutChannelLayer wraps the real, cross-process layer. Sockets in
+this process never join groups on the real layer themselves: the node
+joins each group once, through one channel per event loop, and fans every
+group event out to its member sockets in memory. A user with a phone, a
+desktop and three tabs on the same node costs the real layer one copy of
+each ``user_{id}`` event instead of five, and a busy ``chat_{id}`` group
+one copy per node instead of one per socket.
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chats.layers.NodeFanoutChannelLayer",
+            "CONFIG": {
+                "inner": {
+                    "BACKEND": "channels_redis.core.RedisChannelLayer",
+                    "CONFIG": {"hosts": [("127.0.0.1", 6379)]},
+                },
+            },
+        },
+    }
+
+Local sockets receive the same event dict, so handlers must not mutate it.
+Each socket's queue holds as many events as the inner layer's capacity
+for the channel; events for a full queue are dropped (``fanout.dropped``).
+
+LocalChannelLayer is for single-process deployments and tests: no Redis,
+group messages go straight into bounded in-memory queues.
+
+ShardedRedisChannelLayer spreads groups (and process channels) over
+several Redis hosts with a consistent-hash ring, so adding a host moves
+only about 1/n of the groups; ``manage.py rebalance_channel_layer`` then
+moves their memberships to the new owner.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+import uuid
+import weakref
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from channels_redis.core import RedisChannelLayer
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+FANOUT_TYPE = "node.fanout"
+
+metrics.register_derived(
+    "fanout.dedup_ratio",
+    lambda counters: round(
+        counters.get("fanout.local_deliveries", 0) / counters["fanout.layer_messages"], 3
+    ) if counters.get("fanout.layer_messages") else None
+)
+
+
+class Node:
+    """One event loop's view of the layer: its node channel and local groups."""
+
+    def __init__(self, loop, channel):
+        self.loop = loop
+        self.channel = channel
+        # group -> local channel names, and the reverse
+        self.groups = defaultdict(set)
+        self.memberships = defaultdict(set)
+        self.task = None
+
+
+class NodeFanoutChannelLayer(BaseChannelLayer):
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, inner, **kwargs):
+        super().__init__(**kwargs)
+        backend_class = import_string(inner["BACKEND"])
+        self.inner = backend_class(**inner.get("CONFIG", {}))
+        self.nodes = weakref.WeakKeyDictionary()
+        # local channel name -> (node, queue)
+        self.local = {}
+
+    async def _node(self):
+        loop = asyncio.get_running_loop()
+        node = self.nodes.get(loop)
+        if node is None:
+            channel = await self.inner.new_channel("fanout")
+            # Another coroutine may have created it while we awaited
+            node = self.nodes.setdefault(loop, Node(loop, channel))
+        if node.task is None or node.task.done():
+            node.task = loop.create_task(self._receive_loop(node))
+        return node
+
+    async def _receive_loop(self, node):
+        while True:
+            try:
+                envelope = await self.inner.receive(node.channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error receiving on node channel {node.channel}: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+
+            if envelope.get("type") != FANOUT_TYPE:
+                logger.warning(f"Unexpected message on node channel: {envelope.get('type')}")
+                continue
+            self._fan_out(node, envelope)
+
+    def _fan_out(self, node, envelope):
+        delivered = 0
+        for channel in node.groups.get(envelope["group"], ()):
+            entry = self.local.get(channel)
+            if entry is not None and self._put(entry[1], envelope["message"]):
+                delivered += 1
+
+        metrics.increment("fanout.layer_messages")
+        metrics.increment("fanout.local_deliveries", delivered)
+        # Wall-clock across nodes, so it includes any clock skew between them
+        metrics.observe("fanout.latency", max(time.time() - envelope["sent_at"], 0))
+
+    @staticmethod
+    def _put(queue, message):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # The socket is stuck in a handler or has stopped receiving
+            metrics.increment("fanout.dropped")
+            return False
+        return True
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific"):
+        node = await self._node()
+        channel = f"{prefix}.local!{uuid.uuid4().hex}"
+        self.local[channel] = (node, asyncio.Queue(maxsize=self.inner.get_capacity(channel)))
+        return channel
+
+    async def send(self, channel, message):
+        entry = self.local.get(channel)
+        if entry is None:
+            await self.inner.send(channel, message)
+            return
+
+        node, queue = entry
+        if node.loop is asyncio.get_running_loop():
+            if not self._put(queue, message):
+                raise ChannelFull(channel)
+        else:
+            node.loop.call_soon_threadsafe(self._put, queue, message)
+
+    async def receive(self, channel):
+        entry = self.local.get(channel)
+        if entry is None:
+            return await self.inner.receive(channel)
+
+        node, queue = entry
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # Consumers only stop receiving when they exit; drop sockets that
+            # never joined a group (e.g. rejected in connect)
+            if not node.memberships.get(channel):
+                self.local.pop(channel, None)
+            raise
+
+    async def group_add(self, group, channel):
+        entry = self.local.get(channel)
+        if entry is None:
+            await self.inner.group_add(group, channel)
+            return
+
+        node = entry[0]
+        node.groups[group].add(channel)
+        node.memberships[channel].add(group)
+        # Also refreshes the node's membership expiry on the real layer
+        await self.inner.group_add(group, node.channel)
+
+    async def group_discard(self, group, channel):
+        entry = self.local.get(channel)
+        if entry is None:
+            await self.inner.group_discard(group, channel)
+            return
+
+        node = entry[0]
+        members = node.groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del node.groups[group]
+                await self.inner.group_discard(group, node.channel)
+
+        groups = node.memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                # Left its last group: the socket is closing
+                del node.memberships[channel]
+                self.local.pop(channel, None)
+
+    async def group_send(self, group, message):
+        await self.inner.group_send(group, {
+            "type": FANOUT_TYPE,
+            "group": group,
+            "sent_at": time.time(),
+            "message": message,
+        })
+
+    async def flush(self):
+        self.local.clear()
+        self.nodes.clear()
+        await self.inner.flush()
+
+    async def close(self):
+        if hasattr(self.inner, "close"):
+            await self.inner.close()
+
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf8")).digest()[:8], "big")
+
+
+def host_key(host):
+    """Stable ring identity for a decoded channels_redis host entry."""
+    if "address" in host:
+        return str(host["address"])
+    if "host" in host:
+        return f"{host['host']}:{host.get('port', 6379)}"
+    return repr(sorted(host.items()))
+
+
+class HashRing:
+    """Consistent-hash ring with ``replicas`` virtual points per node."""
+
+    def __init__(self, nodes, replicas=160):
+        points = sorted(
+            (_ring_hash(f"{node}#{replica}"), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def lookup(self, value):
+        position = bisect.bisect(self._hashes, _ring_hash(value))
+        return self._indexes[position % len(self._hashes)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer whose host is chosen from a consistent-hash ring.
+
+    channels_redis already keeps a group's membership on the group's host
+    and a process channel's queue on the channel's host; it picks the host
+    with ``crc32 % hosts``, which remaps almost every group when a host is
+    added. Here the ring is keyed by host address, so hosts can be
+    appended (keep existing entries spelled the same) and only the groups
+    that now hash to the new host move.
+
+    Adding a host: roll out the new ``hosts`` list, then run
+    ``manage.py rebalance_channel_layer`` (again once the rollout is done,
+    in case old processes re-added members on the previous owner). Until a
+    group is moved, its members also recover by re-joining on reconnect.
+    """
+
+    def __init__(self, hosts=None, ring_replicas=160, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing([host_key(host) for host in self.hosts], ring_replicas)
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        # send() hashes the full process channel name and receive() the part
+        # up to "!": hash the same part for both
+        if "!" in value:
+            value = self.non_local_name(value)
+        return self.ring.lookup(value)
+
+    async def rebalance(self, dry_run=False):
+        """
+        Move group memberships to the host that owns them on the current
+        ring. Returns the names of the groups that were (or would be) moved.
+        """
+        prefix = self._group_key("")
+        moved = []
+
+        for index in range(self.ring_size):
+            connection = self.connection(index)
+            async for key in connection.scan_iter(match=prefix + b"*", count=500):
+                group = key[len(prefix):].decode("utf8")
+                owner = self.consistent_hash(group)
+                if owner == index:
+                    continue
+
+                moved.append(group)
+                if dry_run:
+                    continue
+
+                members = await connection.zrange(key, 0, -1, withscores=True)
+                if members:
+                    target = self.connection(owner)
+                    # Keep the newer join time if the member already re-joined
+                    await target.zadd(key, dict(members), gt=True)
+                    await target.expire(key, self.group_expiry)
+                await connection.delete(key)
+
+        return moved
+
+
+class LocalChannel:
+    __slots__ = ("queue", "loop")
+
+    def __init__(self, capacity):
+        # (expires_at, message) pairs; loop is set by the first receive()
+        self.queue = asyncio.Queue(maxsize=capacity)
+        self.loop = None
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    """
+    Channel layer for a single ASGI process.
+
+    Same semantics as channels' InMemoryChannelLayer (bounded channels,
+    message expiry, group expiry, group messages to a full channel are
+    dropped), but group_send puts one shared copy of the message straight
+    into each member's queue, with no task or deepcopy per member, and
+    expiry is checked per message and per membership as they are touched
+    instead of by scanning every channel and group on each call.
+
+    A member whose queue is full of expired messages has stopped receiving
+    and is removed from its groups.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.group_expiry = group_expiry
+        self.channels = {}
+        # group -> {channel: joined at}, and channel -> groups
+        self.groups = defaultdict(dict)
+        self.memberships = defaultdict(set)
+
+    def _channel(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = LocalChannel(self.get_capacity(name))
+        return channel
+
+    def _deliver(self, name, message, now):
+        channel = self._channel(name)
+        queue = channel.queue
+        if queue.full():
+            if queue._queue[0][0] <= now:
+                # Nobody has received for a whole expiry period
+                self._remove(name)
+            metrics.increment("layer.dropped")
+            return False
+
+        item = (now + self.expiry, message)
+        loop = channel.loop
+        if loop is None or loop is asyncio.get_running_loop():
+            queue.put_nowait(item)
+        else:
+            # Sent from another thread's loop (e.g. async_to_sync)
+            loop.call_soon_threadsafe(self._put, queue, item)
+        return True
+
+    @staticmethod
+    def _put(queue, item):
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            metrics.increment("layer.dropped")
+
+    def _leave(self, group, name):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(name, None)
+            if not members:
+                del self.groups[group]
+
+        groups = self.memberships.get(name)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.memberships[name]
+
+    def _remove(self, name):
+        for group in list(self.memberships.get(name, ())):
+            self._leave(group, name)
+        self.channels.pop(name, None)
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific"):
+        name = f"{prefix}.local!{uuid.uuid4().hex}"
+        self._channel(name)
+        return name
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if not self._deliver(channel, dict(message), time.time()):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        local = self._channel(channel)
+        local.loop = asyncio.get_running_loop()
+        try:
+            while True:
+                expires_at, message = await local.queue.get()
+                if expires_at > time.time():
+                    return message
+        except asyncio.CancelledError:
+            # Consumers only stop receiving when they exit
+            if not self.memberships.get(channel):
+                self.channels.pop(channel, None)
+            raise
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups[group][channel] = time.time()
+        self.memberships[channel].add(group)
+
+    async def group_discard(self, group, channel):
+        self._leave(group, channel)
+
+    async def group_send(self, group, message):
+        members = self.groups.get(group)
+        if not members:
+            return
+
+        # One copy for every member (see the module docstring)
+        message = dict(message)
+        now = time.time()
+        joined_after = now - self.group_expiry
+        for channel, joined_at in list(members.items()):
+            if joined_at < joined_after:
+                self._leave(group, channel)
+            else:
+                self._deliver(channel, message, now)
+
+    async def flush(self):
+        self.channels.clear()
+        self.groups.clear()
+        self.memberships.clear()
+
+    async def close(self):
+        pass
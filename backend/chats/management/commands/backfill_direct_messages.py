@@ -0,0 +1,160 @@
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Max, Min, Q
+from django.db.models.functions import Greatest
+
+from chats.models import Conversation, InboxEntry, Message, PersonalMessage, UnreadCounter
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy legacy PersonalMessage rows into the conversation-keyed Message "
+        "table. Runs in small transactions so it is safe against a live "
+        "database, and resumes where it stopped (rows are matched by legacy_id)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument(
+            '--sleep', type=float, default=0.0,
+            help="Seconds to pause between chunks to limit load on the database"
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = Message.objects.aggregate(last=Max('legacy_id'))['last'] or 0
+        copied = 0
+
+        while True:
+            chunk = list(
+                PersonalMessage.objects.filter(id__gt=last_id).order_by('id')[:chunk_size]
+            )
+            if not chunk:
+                break
+
+            copied += self.copy_chunk(chunk)
+            last_id = chunk[-1].id
+            self.stdout.write(f"Copied {copied} messages (up to PersonalMessage {last_id})")
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f"Backfill complete: {copied} messages copied"))
+
+    @transaction.atomic
+    def copy_chunk(self, chunk):
+        conversations = {}
+        created = set()
+        by_pair = defaultdict(list)
+
+        for legacy in chunk:
+            pair = tuple(sorted((legacy.sender_id, legacy.receiver_id)))
+            by_pair[pair].append(legacy)
+            if pair not in conversations:
+                conversation = Conversation.objects.filter(
+                    conversation_type='direct', user1_id=pair[0], user2_id=pair[1]
+                ).first()
+                if conversation is None:
+                    conversation = Conversation.objects.create(
+                        conversation_type='direct', user1_id=pair[0], user2_id=pair[1]
+                    )
+                    conversation.sync_inbox_entries()
+                    created.add(pair)
+                conversations[pair] = conversation
+
+        messages = []
+        for pair, rows in by_pair.items():
+            conversation = conversations[pair]
+            first_seq = self.first_legacy_seq(conversation, len(rows))
+            messages.extend(
+                Message(
+                    conversation=conversation,
+                    sender_id=legacy.sender_id,
+                    text=legacy.message,
+                    is_read=legacy.is_read,
+                    seq=first_seq + offset,
+                    legacy_id=legacy.id
+                )
+                for offset, legacy in enumerate(rows)
+            )
+
+        # bulk_create skips Message.save(), so conversation metadata and
+        # sequences are left alone; auto_now_add stamps "now", so restore
+        # the original send times afterwards
+        timestamps = {legacy.id: legacy.timestamp for legacy in chunk}
+        before = Message.objects.filter(legacy_id__in=timestamps).count()
+        Message.objects.bulk_create(messages, ignore_conflicts=True)
+        copied = list(Message.objects.filter(legacy_id__in=timestamps))
+        for message in copied:
+            message.timestamp = timestamps[message.legacy_id]
+        Message.objects.bulk_update(copied, ['timestamp'])
+
+        for pair, conversation in conversations.items():
+            self.update_conversation(
+                conversation,
+                [message for message in messages if message.conversation is conversation],
+                timestamps,
+                created=pair in created
+            )
+        UnreadCounter.recount({user_id for pair in conversations for user_id in pair})
+        return len(copied) - before
+
+    @staticmethod
+    def first_legacy_seq(conversation, count):
+        """
+        The first of ``count`` free sequence numbers for legacy messages.
+        Legacy messages predate every live one, so they take the lowest
+        numbers in id (= send) order: those after the highest one copied so
+        far (not a count of copied rows, which drops below it once any of
+        them is deleted), which migration 0003 reserved for the pairs that
+        had a conversation then. Pairs whose conversation started later may
+        already have live messages there; their history then goes after
+        the live messages rather than reuse a seq.
+        """
+        seqs = Message.objects.filter(conversation=conversation).aggregate(
+            copied=Max('seq', filter=Q(legacy_id__isnull=False)),
+            first_live=Min('seq', filter=Q(legacy_id__isnull=True)),
+        )
+        first_seq = (seqs['copied'] or 0) + 1
+        if seqs['first_live'] is not None and first_seq + count > seqs['first_live']:
+            return conversation.allocate_seqs(count)
+        return first_seq
+
+    @staticmethod
+    def update_conversation(conversation, messages, timestamps, created):
+        """
+        Bring a conversation's sequence, read seqs and last-message fields
+        up to the copied ``messages``; never moves any of them back.
+        """
+        # Each user has read what they sent and whatever is marked read
+        read_seqs = {conversation.user1_id: 0, conversation.user2_id: 0}
+        for message in messages:
+            for user_id in read_seqs:
+                if message.sender_id == user_id or message.is_read:
+                    read_seqs[user_id] = max(read_seqs[user_id], message.seq)
+
+        Conversation.objects.filter(id=conversation.id).update(
+            last_seq=Greatest(F('last_seq'), max(message.seq for message in messages)),
+            user1_read_seq=Greatest(F('user1_read_seq'), read_seqs[conversation.user1_id]),
+            user2_read_seq=Greatest(F('user2_read_seq'), read_seqs[conversation.user2_id]),
+        )
+
+        newest = max(messages, key=lambda message: message.seq)
+        newest_time = timestamps[newest.legacy_id]
+        rows = Conversation.objects.filter(id=conversation.id)
+        if not created:
+            rows = rows.filter(Q(last_message_time__lt=newest_time) | Q(last_message_time__isnull=True))
+        rows.update(
+            last_message=newest.text,
+            last_message_time=newest_time,
+            last_message_sender_id=newest.sender_id,
+        )
+
+        # New inbox rows were stamped "now"; existing ones only move forward
+        entries = InboxEntry.objects.filter(conversation=conversation)
+        if not created:
+            entries = entries.filter(last_activity__lt=newest_time)
+        entries.update(last_activity=newest_time)
@@ -0,0 +1,91 @@
+import asyncio
+import statistics
+import time
+
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+from django.core.management.base import BaseCommand
+
+from chats.layers import LocalChannelLayer
+
+GROUP = "bench_layer"
+
+
+def summary(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50 {statistics.median(samples) * 1000:.3f} ms  p99 {p99 * 1000:.3f} ms"
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark group fan-out on the in-process LocalChannelLayer against "
+        "channels' InMemoryChannelLayer and Redis. Redis keys use their own "
+        "prefix and are removed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=100)
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--redis', default='redis://127.0.0.1:6379')
+        parser.add_argument('--timeout', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        members, messages = options['members'], options['messages']
+        # Large enough that nothing is dropped: this measures delivery, not overflow
+        capacity = messages + 1
+        layers = [
+            ("local", lambda: LocalChannelLayer(capacity=capacity)),
+            ("inmemory", lambda: InMemoryChannelLayer(capacity=capacity)),
+            ("redis", lambda: RedisChannelLayer(
+                hosts=[options['redis']], prefix="bench-layer", capacity=capacity
+            )),
+        ]
+
+        self.stdout.write(f"{members} members, {messages} group messages")
+        self.stdout.write("")
+        for name, factory in layers:
+            try:
+                delivered, elapsed, latencies = asyncio.run(
+                    self.run(factory(), members, messages, options['timeout'])
+                )
+            except Exception as e:
+                self.stdout.write(f"  {name:<9} skipped: {str(e)}")
+                continue
+
+            self.stdout.write(
+                f"  {name:<9} {delivered / elapsed:>10,.0f} events/s  {summary(latencies)}"
+                + ("" if delivered == members * messages else f"  ({delivered} delivered)")
+            )
+
+    async def run(self, layer, members, messages, timeout):
+        channels = [await layer.new_channel("bench") for _ in range(members)]
+        for channel in channels:
+            await layer.group_add(GROUP, channel)
+
+        latencies = []
+
+        async def consume(channel):
+            for _ in range(messages):
+                message = await layer.receive(channel)
+                latencies.append(time.perf_counter() - message["sent_at"])
+
+        consumers = [asyncio.create_task(consume(channel)) for channel in channels]
+        start = time.perf_counter()
+        try:
+            for _ in range(messages):
+                await layer.group_send(GROUP, {"type": "bench.message", "sent_at": time.perf_counter()})
+                # Let receivers run, as a live server would between events
+                await asyncio.sleep(0)
+            await asyncio.wait_for(asyncio.gather(*consumers), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            elapsed = time.perf_counter() - start
+            for task in consumers:
+                task.cancel()
+            await layer.flush()
+            if hasattr(layer, "close_pools"):
+                await layer.close_pools()
+
+        return len(latencies), elapsed, latencies
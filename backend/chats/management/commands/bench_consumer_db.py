@@ -0,0 +1,119 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chats.context import load_conversation_contexts
+from chats.models import Conversation, Message
+from chats.snapshot import build_snapshot
+
+User = get_user_model()
+
+
+def network_delay(seconds):
+    """Query wrapper standing in for the round trip to a database server."""
+    def wrapper(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+    return wrapper
+
+
+def handshake(user_id, conversation_id, latency):
+    """The database work of a socket connecting with ?snapshot=1."""
+    with connection.execute_wrapper(network_delay(latency)):
+        user = User.objects.get(id=user_id)
+        context = load_conversation_contexts(user, [conversation_id])[conversation_id]
+        return build_snapshot(context, user)
+
+
+def summary(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50 {statistics.median(samples) * 1000:.1f} ms  p99 {p99 * 1000:.1f} ms"
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark concurrent socket handshakes (auth, context load, snapshot) "
+        "on the shared sync_to_async thread against the CHAT_DB_CONCURRENCY "
+        "pool. Creates a throwaway group and deletes it afterwards. SQLite is "
+        "in-process, so --latency adds a per-query delay for the network "
+        "round trip to a database server. The pool size defaults to "
+        "CHAT_DB_CONCURRENCY as configured: the numbers are for a database "
+        "server, since on SQLite the server runs the pool with one thread."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=200)
+        parser.add_argument('--members', type=int, default=50)
+        parser.add_argument(
+            '--concurrency', type=int, default=getattr(settings, "CHAT_DB_CONCURRENCY", 8)
+        )
+        parser.add_argument(
+            '--latency', type=float, default=1.0,
+            help="Simulated milliseconds per query (0 to disable)"
+        )
+
+    def handle(self, *args, **options):
+        members = User.objects.bulk_create([
+            User(email=f"bench-db-{time.time_ns()}-{i}@example.invalid")
+            for i in range(options['members'])
+        ])
+        group = Conversation.objects.create(
+            name=f"bench-db-{time.time_ns()}", conversation_type='group', created_by=members[0]
+        )
+        try:
+            group.participants.set(members)
+            group.sync_group_participants()
+            Message.objects.bulk_create([
+                Message(conversation=group, sender=members[i % len(members)], text=f"message {i}", seq=i + 1)
+                for i in range(100)
+            ])
+            self.run(
+                group, members, options['connections'],
+                options['concurrency'], options['latency'] / 1000
+            )
+        finally:
+            group.delete()
+            User.objects.filter(id__in=[member.id for member in members]).delete()
+
+    def run(self, group, members, connections, concurrency, latency):
+        out = self.stdout.write
+        out(
+            f"{connections} concurrent handshakes, group of {len(members)}, "
+            f"{latency * 1000:g} ms per query"
+        )
+        out("")
+
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        runners = [
+            ("shared thread (sync_to_async)", DatabaseSyncToAsync(handshake)),
+            (f"pool of {concurrency} (db_task)",
+             DatabaseSyncToAsync(handshake, thread_sensitive=False, executor=executor)),
+        ]
+        for name, runner in runners:
+            elapsed, latencies = asyncio.run(
+                self.connect_all(runner, group, members, connections, latency)
+            )
+            out(f"  {name:<32} {connections / elapsed:>8,.0f} handshakes/s  {summary(latencies)}")
+        executor.shutdown()
+
+    async def connect_all(self, runner, group, members, connections, latency):
+        latencies = []
+
+        async def connect(user_id):
+            start = time.perf_counter()
+            await runner(user_id, group.id, latency)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            connect(members[i % len(members)].id) for i in range(connections)
+        ))
+        return time.perf_counter() - start, latencies
@@ -0,0 +1,99 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats.models import Conversation, GroupParticipant, Message
+from chats.receipts import advance_watermark, read_counts, readers_of
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def summary(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50 {statistics.median(samples):.3f} ms  p99 {p99:.3f} ms"
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark watermark read receipts against per-message receipt writes. "
+        "Runs inside a transaction that is rolled back, so no data is kept."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--page-size', type=int, default=50)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['members'], options['messages'], options['page_size'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, member_count, message_count, page_size):
+        out = self.stdout.write
+        members = User.objects.bulk_create([
+            User(email=f"bench-receipts-{i}@example.invalid") for i in range(member_count)
+        ])
+        group = Conversation.objects.create(
+            name=f"bench-receipts-{time.time_ns()}",
+            conversation_type='group',
+            created_by=members[0]
+        )
+        group.participants.set(members)
+        group.sync_group_participants()
+
+        messages = Message.objects.bulk_create([
+            Message(conversation=group, sender=members[i % member_count], text=f"message {i}", seq=i + 1)
+            for i in range(message_count)
+        ])
+        Conversation.objects.filter(id=group.id).update(last_seq=message_count)
+        page = messages[-page_size:]
+        page_ids = [m.id for m in page]
+
+        out(f"{member_count} members, {message_count} messages, page of {page_size}")
+        out("")
+        out("Storage if every member reads every message")
+        out(f"  per-message receipts (read_by rows): {message_count * (member_count - 1):,}")
+        out(f"  watermarks (GroupParticipant rows):  {GroupParticipant.objects.filter(conversation=group).count():,}")
+        out("")
+
+        # One receipt covering the page, for every member
+        watermark_samples = [
+            timed(advance_watermark, group.id, member, page_ids) for member in members
+        ]
+
+        # The replaced path issued a write per message in the receipt
+        def per_message_receipt(ids):
+            for message_id in ids:
+                Message.objects.filter(id=message_id).update(is_read=True)
+
+        per_message_samples = [
+            timed(per_message_receipt, page_ids) for _ in members[:min(50, member_count)]
+        ]
+
+        out(f"Receipt for {page_size} messages")
+        out(f"  per-message writes: {summary(per_message_samples)}")
+        out(f"  watermark update:   {summary(watermark_samples)}")
+        out("")
+
+        count_samples = [timed(read_counts, group.id, page) for _ in range(50)]
+        readers_samples = [timed(lambda m: list(readers_of(m)), page[0]) for _ in range(50)]
+        out(f"Read counts for page: {summary(count_samples)}")
+        out(f"Readers of a message: {summary(readers_samples)}")
@@ -0,0 +1,41 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from chats.layers import ShardedRedisChannelLayer
+
+
+class Command(BaseCommand):
+    help = (
+        "Move channel layer group memberships to the Redis host that owns "
+        "them on the consistent-hash ring. Run after adding hosts to "
+        "CHANNEL_LAYERS; safe to run repeatedly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layer', default='default', help="CHANNEL_LAYERS alias")
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only report the groups that would move"
+        )
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer(options['layer'])
+        # The node fan-out layer wraps the Redis layer
+        layer = getattr(layer, 'inner', layer)
+        if not isinstance(layer, ShardedRedisChannelLayer):
+            raise CommandError(f"Layer '{options['layer']}' is not a ShardedRedisChannelLayer")
+
+        moved = asyncio.run(self.rebalance(layer, options['dry_run']))
+
+        verb = "Would move" if options['dry_run'] else "Moved"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {len(moved)} groups across {layer.ring_size} hosts"
+        ))
+
+    async def rebalance(self, layer, dry_run):
+        try:
+            return await layer.rebalance(dry_run=dry_run)
+        finally:
+            await layer.close_pools()
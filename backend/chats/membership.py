@@ -0,0 +1,92 @@
+"""
+Conversation membership checks backed by the shared Django cache.
+
+Every answer is cached per (conversation, user) under a per-conversation
+version key. Views that change membership call ``invalidate`` which bumps
+the version, so all processes stop reading the old entries at once.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Conversation
+
+MEMBERSHIP_CACHE_TIMEOUT = getattr(settings, "CHAT_MEMBERSHIP_CACHE_TIMEOUT", 60 * 60)
+
+
+def _version_key(conversation_id):
+    return f"membership:version:{conversation_id}"
+
+
+def _member_key(conversation_id, version, user_id):
+    return f"membership:{conversation_id}:{version}:{user_id}"
+
+
+def _member_filter(user_id):
+    return (
+        Q(conversation_type='direct', user1_id=user_id) |
+        Q(conversation_type='direct', user2_id=user_id) |
+        Q(conversation_type='group', participants=user_id)
+    )
+
+
+def _get_versions(conversation_ids):
+    keys = {_version_key(cid): cid for cid in conversation_ids}
+    found = cache.get_many(keys)
+    versions = {keys[key]: version for key, version in found.items()}
+
+    for conversation_id in conversation_ids:
+        if conversation_id not in versions:
+            # A fresh version per start-up/eviction never collides with old entries
+            key = _version_key(conversation_id)
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[conversation_id] = cache.get(key)
+    return versions
+
+
+def member_conversation_ids(user_id, conversation_ids):
+    """Return the subset of ``conversation_ids`` that ``user_id`` belongs to."""
+    conversation_ids = set(conversation_ids)
+    if not conversation_ids:
+        return set()
+
+    versions = _get_versions(conversation_ids)
+    keys = {
+        _member_key(cid, versions[cid], user_id): cid
+        for cid in conversation_ids
+    }
+    cached = cache.get_many(keys)
+
+    members = {keys[key] for key, is_member_flag in cached.items() if is_member_flag}
+    missing = conversation_ids - {keys[key] for key in cached}
+
+    if missing:
+        found = set(
+            Conversation.objects.filter(id__in=missing).filter(
+                _member_filter(user_id)
+            ).values_list('id', flat=True).distinct()
+        )
+        cache.set_many(
+            {
+                _member_key(cid, versions[cid], user_id): 1 if cid in found else 0
+                for cid in missing
+            },
+            timeout=MEMBERSHIP_CACHE_TIMEOUT
+        )
+        members |= found
+    return members
+
+
+def is_member(user_id, conversation_id):
+    return conversation_id in member_conversation_ids(user_id, [conversation_id])
+
+
+def invalidate(conversation_id):
+    """Drop cached answers for a conversation once the current transaction commits."""
+    transaction.on_commit(
+        lambda: cache.set(_version_key(conversation_id), time.time_ns(), timeout=None)
+    )
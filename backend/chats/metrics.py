@@ -0,0 +1,62 @@
+"""
+In-process counters and timers for the realtime path.
+
+Every worker keeps its own numbers; the admin-only ``api/metrics/``
+endpoint reports the worker that serves the request. Timers keep a
+bounded window of recent samples for percentiles.
+"""
+
+import threading
+from collections import defaultdict, deque
+
+TIMER_WINDOW = 1024
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timers = defaultdict(lambda: deque(maxlen=TIMER_WINDOW))
+_derived = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, seconds):
+    with _lock:
+        _timers[name].append(seconds)
+
+
+def register_derived(name, compute):
+    """Report ``compute(counters)`` under ``name`` (e.g. a ratio of two counters)."""
+    _derived[name] = compute
+
+
+def _percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        timers = {name: sorted(samples) for name, samples in _timers.items()}
+
+    return {
+        "counters": counters,
+        "derived": {name: compute(counters) for name, compute in _derived.items()},
+        "timers": {
+            name: {
+                "count": len(samples),
+                "p50_ms": round(_percentile(samples, 0.5) * 1000, 3),
+                "p99_ms": round(_percentile(samples, 0.99) * 1000, 3),
+                "max_ms": round(samples[-1] * 1000, 3),
+            }
+            for name, samples in timers.items() if samples
+        },
+    }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
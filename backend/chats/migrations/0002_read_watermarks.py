@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:31
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_read_watermarks(apps, schema_editor):
+    Conversation = apps.get_model('chats', 'Conversation')
+    GroupParticipant = apps.get_model('chats', 'GroupParticipant')
+    Message = apps.get_model('chats', 'Message')
+
+    # Every group member needs a participant row to carry a watermark
+    members = Conversation.participants.through.objects.filter(
+        conversation__conversation_type='group'
+    ).values_list('conversation_id', 'user_id')
+    GroupParticipant.objects.bulk_create(
+        [GroupParticipant(conversation_id=cid, user_id=uid) for cid, uid in members],
+        ignore_conflicts=True,
+        batch_size=1000
+    )
+
+    # The highest message a user is recorded as having read becomes their watermark
+    watermarks = Message.read_by.through.objects.values(
+        'user_id', 'message__conversation_id'
+    ).annotate(last_read=Max('message_id'))
+
+    for row in watermarks.iterator():
+        GroupParticipant.objects.filter(
+            conversation_id=row['message__conversation_id'],
+            user_id=row['user_id']
+        ).update(last_read_message_id=row['last_read'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupparticipant',
+            name='last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='groupparticipant',
+            index=models.Index(fields=['conversation', 'last_read_message_id'], name='chats_group_convers_a25304_idx'),
+        ),
+        migrations.RunPython(backfill_read_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='read_by',
+        ),
+    ]
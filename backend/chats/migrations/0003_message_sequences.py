@@ -0,0 +1,87 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:33
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def backfill_sequences(apps, schema_editor):
+    Conversation = apps.get_model('chats', 'Conversation')
+    GroupParticipant = apps.get_model('chats', 'GroupParticipant')
+    Message = apps.get_model('chats', 'Message')
+    PersonalMessage = apps.get_model('chats', 'PersonalMessage')
+
+    for conversation in Conversation.objects.iterator():
+        if conversation.conversation_type == 'group':
+            messages = list(Message.objects.filter(conversation=conversation).order_by('timestamp', 'id'))
+            for seq, message in enumerate(messages, start=1):
+                message.seq = seq
+            Message.objects.bulk_update(messages, ['seq'], batch_size=1000)
+            conversation.last_seq = len(messages)
+
+            # Keep each member's existing unread count: read_seq = last_seq - unread
+            for participant in GroupParticipant.objects.filter(conversation=conversation):
+                participant.last_read_seq = max(conversation.last_seq - participant.unread_count, 0)
+                participant.save(update_fields=['last_read_seq'])
+        else:
+            conversation.last_seq = PersonalMessage.objects.filter(
+                Q(sender_id=conversation.user1_id, receiver_id=conversation.user2_id) |
+                Q(sender_id=conversation.user2_id, receiver_id=conversation.user1_id)
+            ).count()
+            conversation.user1_read_seq = max(conversation.last_seq - conversation.unread_count_user1, 0)
+            conversation.user2_read_seq = max(conversation.last_seq - conversation.unread_count_user2, 0)
+
+        conversation.save(update_fields=['last_seq', 'user1_read_seq', 'user2_read_seq'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0002_read_watermarks'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user1_read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user2_read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='groupparticipant',
+            name='last_read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'seq'], name='chats_messa_convers_f1a2cb_idx'),
+        ),
+        migrations.RunPython(backfill_sequences, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='conversation',
+            name='unread_count_user1',
+        ),
+        migrations.RemoveField(
+            model_name='conversation',
+            name='unread_count_user2',
+        ),
+        migrations.RemoveField(
+            model_name='groupparticipant',
+            name='unread_count',
+        ),
+    ]
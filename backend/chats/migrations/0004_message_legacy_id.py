@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_message_sequences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='legacy_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_inbox_entries(apps, schema_editor):
+    Conversation = apps.get_model('chats', 'Conversation')
+    InboxEntry = apps.get_model('chats', 'InboxEntry')
+
+    entries = []
+    for conversation in Conversation.objects.iterator():
+        last_activity = conversation.last_message_time or conversation.created_at
+        if conversation.conversation_type == 'direct':
+            peers = {conversation.user1_id: conversation.user2_id, conversation.user2_id: conversation.user1_id}
+        else:
+            peers = {uid: None for uid in conversation.participants.values_list('id', flat=True)}
+
+        entries.extend(
+            InboxEntry(user_id=uid, conversation_id=conversation.id, peer_id=peer_id, last_activity=last_activity)
+            for uid, peer_id in peers.items() if uid
+        )
+
+    InboxEntry.objects.bulk_create(entries, ignore_conflicts=True, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_message_legacy_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity', models.DateTimeField()),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='chats.conversation')),
+                ('peer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_activity', '-id'], name='chats_inbox_user_id_83f915_idx')],
+                'unique_together': {('user', 'conversation')},
+            },
+        ),
+        migrations.RunPython(backfill_inbox_entries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_unread_counters(apps, schema_editor):
+    Conversation = apps.get_model('chats', 'Conversation')
+    GroupParticipant = apps.get_model('chats', 'GroupParticipant')
+    UnreadCounter = apps.get_model('chats', 'UnreadCounter')
+
+    totals = {}
+    for conversation in Conversation.objects.filter(conversation_type='direct').iterator():
+        for user_id, read_seq in (
+            (conversation.user1_id, conversation.user1_read_seq),
+            (conversation.user2_id, conversation.user2_read_seq),
+        ):
+            if user_id:
+                totals[user_id] = totals.get(user_id, 0) + conversation.last_seq - read_seq
+
+    participants = GroupParticipant.objects.filter(
+        conversation__conversation_type='group'
+    ).values_list('user_id', 'conversation__last_seq', 'last_read_seq')
+    for user_id, last_seq, read_seq in participants.iterator():
+        totals[user_id] = totals.get(user_id, 0) + last_seq - read_seq
+
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(user_id=user_id, total=total) for user_id, total in totals.items()],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('chats', '0005_inbox_entries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread_counter', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(backfill_unread_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:49
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def merge_read_watermarks(apps, schema_editor):
+    GroupParticipant = apps.get_model('chats', 'GroupParticipant')
+    Message = apps.get_model('chats', 'Message')
+    UnreadCounter = apps.get_model('chats', 'UnreadCounter')
+
+    # Having read a message means having read everything before it, so the
+    # id watermark can only move the seq one forward
+    watermark_seqs = Message.objects.filter(
+        conversation_id=OuterRef('conversation_id'),
+        id=OuterRef('last_read_message_id')
+    ).values('seq')
+    behind = GroupParticipant.objects.annotate(
+        watermark_seq=Subquery(watermark_seqs)
+    ).filter(watermark_seq__gt=F('last_read_seq'))
+
+    for participant in behind.iterator():
+        newly_read = participant.watermark_seq - participant.last_read_seq
+        GroupParticipant.objects.filter(id=participant.id).update(last_read_seq=participant.watermark_seq)
+        UnreadCounter.objects.filter(user_id=participant.user_id).update(total=F('total') - newly_read)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_outbox_events'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_read_watermarks, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='groupparticipant',
+            name='chats_group_convers_a25304_idx',
+        ),
+        migrations.RemoveField(
+            model_name='groupparticipant',
+            name='last_read_message_id',
+        ),
+        migrations.AddIndex(
+            model_name='groupparticipant',
+            index=models.Index(fields=['conversation', 'last_read_seq'], name='chats_group_convers_247d58_idx'),
+        ),
+    ]
@@ -1,11 +1,21 @@
+from collections import defaultdict
+
 from django.db import models
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q,F
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q,F,Sum,Case,When
 from django.utils import timezone
+from .db import write_transaction
 
 User = get_user_model()
 
-# For SIMPLE direct messaging (no conversation overhead)
+UNREAD_CACHE_TIMEOUT = getattr(settings, "CHAT_UNREAD_CACHE_TIMEOUT", 5 * 60)
+
+# Legacy store for direct messages. New direct messages are written to
+# Message like group messages; `manage.py backfill_direct_messages` copies
+# the rows kept here into it.
 class PersonalMessage(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
@@ -48,9 +58,12 @@ class Conversation(models.Model):
     last_message_time = models.DateTimeField(blank=True, null=True)
     last_message_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name="+")
 
-    # Unread counts(direct only)
-    unread_count_user1 = models.PositiveIntegerField(default=0)
-    unread_count_user2 = models.PositiveIntegerField(default=0)
+    # Message sequence: bumped once per message. Unread count for a member is
+    # last_seq minus the last sequence they read (direct read seqs live here,
+    # group read seqs on GroupParticipant)
+    last_seq = models.PositiveBigIntegerField(default=0)
+    user1_read_seq = models.PositiveBigIntegerField(default=0)
+    user2_read_seq = models.PositiveBigIntegerField(default=0)
 
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -91,6 +104,8 @@ class Conversation(models.Model):
                 'conversation_type': 'direct'
             }
         )
+        if created:
+            conversation.sync_inbox_entries()
         return conversation, created
 
     def get_other_user(self, user):
@@ -99,26 +114,85 @@ class Conversation(models.Model):
         return self.user2 if user == self.user1 else self.user1
 
     def get_unread_count_for_user(self, user):
-        if user == self.user1:
+        if user.id == self.user1_id:
             return self.unread_count_user1
-        elif user == self.user2:
+        elif user.id == self.user2_id:
             return self.unread_count_user2
         return 0
 
-    def increment_unread_for_receiver(self, sender):
-        if sender == self.user1:
-            self.unread_count_user2 += 1
-        elif sender == self.user2:
-            self.unread_count_user1 += 1
-        self.save()
+    @property
+    def unread_count_user1(self):
+        return self.last_seq - self.user1_read_seq
+
+    @property
+    def unread_count_user2(self):
+        return self.last_seq - self.user2_read_seq
+
+    def allocate_seqs(self, count=1):
+        """
+        Reserve the next ``count`` sequence numbers and return the first one.
+        Must run inside a transaction so the row stays locked until commit.
+        """
+        Conversation.objects.filter(id=self.id).update(last_seq=F('last_seq') + count)
+        self.last_seq = Conversation.objects.values_list('last_seq', flat=True).get(id=self.id)
+        return self.last_seq - count + 1
+
+    def advance_read_seq(self, user, seq=None):
+        """
+        Mark the conversation read up to ``seq`` (default: everything) for
+        ``user``; never moves back. Keeps the user's UnreadCounter in step
+        and returns how many messages became read.
+        """
+        if self.conversation_type == 'direct':
+            if user.id == self.user1_id:
+                field = 'user1_read_seq'
+            elif user.id == self.user2_id:
+                field = 'user2_read_seq'
+            else:
+                return 0
+            rows = Conversation.objects.filter(id=self.id)
+            current = rows.select_for_update().values(field, 'last_seq').first()
+        else:
+            field = 'last_read_seq'
+            rows = self.group_participants.filter(user=user)
+            current = rows.select_for_update(of=('self',)).values(
+                field, last_seq=F('conversation__last_seq')
+            ).first()
+
+        if current is None:
+            return 0
+        seq = current['last_seq'] if seq is None else min(seq, current['last_seq'])
+        newly_read = seq - current[field]
+        if newly_read <= 0:
+            return 0
+
+        if self.conversation_type == 'direct':
+            rows.update(**{field: seq})
+        else:
+            rows.update(**{field: seq}, last_read=timezone.now())
+        UnreadCounter.subtract(user.id, newly_read)
+        return newly_read
+
+    def record_last_message(self, sender, text, timestamp, seq=None):
+        """
+        Store last-message metadata; the sender has read everything up to
+        ``seq`` (default: last_seq). Must run in the transaction that
+        allocated the sequence numbers.
+        """
+        self.advance_read_seq(sender, seq)
+        Conversation.objects.filter(id=self.id).update(
+            last_message=text,
+            last_message_time=timestamp,
+            last_message_sender=sender,
+        )
+        # Re-sort the conversation in every member's inbox (one statement)
+        self.inbox_entries.update(last_activity=timestamp)
 
     def reset_unread_for_user(self, user):
         """Reset unread count for a user"""
-        if user == self.user1:
-            self.unread_count_user1 = 0
-        elif user == self.user2:
-            self.unread_count_user2 = 0
-        self.save()
+        if self.conversation_type == 'direct':
+            with write_transaction():
+                self.advance_read_seq(user)
 
     def __str__(self):
         if self.conversation_type == 'direct':
@@ -131,47 +205,84 @@ class Conversation(models.Model):
             return 0
         try:
             participant= self.group_participants.get(user=user)
-            return participant.unread_count
+            return self.last_seq - participant.last_read_seq
         except GroupParticipant.DoesNotExist:
             return 0
-        
-    def increment_group_unread_for_all(self,sender):
+
+    def reset_group_unread_for_user(self,user):
         if self.conversation_type!='group':
             return
-        self.group_participants.exclude(user=sender).update(unread_count=F('unread_count')+1)
+        with write_transaction():
+            self.advance_read_seq(user)
 
-    def reset_group_unread_for_user(self,user):
+    def sync_group_participants(self):
+        """Make sure every member has GroupParticipant and InboxEntry rows (and nobody else does)."""
         if self.conversation_type!='group':
             return
-        try:
-            participant=self.group_participants.get(user=user)
-            participant.unread_count=0
-            participant.last_read=timezone.now()
-            participant.save()
-        except GroupParticipant.DoesNotExist:
-            pass
+        member_ids = set(self.participants.values_list('id', flat=True))
+        self.group_participants.exclude(user_id__in=member_ids).delete()
+        GroupParticipant.objects.bulk_create(
+            [GroupParticipant(conversation=self, user_id=uid) for uid in member_ids],
+            ignore_conflicts=True
+        )
+        self.sync_inbox_entries(member_ids)
+
+    def sync_inbox_entries(self, member_ids=None):
+        """Make sure every member has an InboxEntry row (and nobody else does)."""
+        if self.conversation_type == 'direct':
+            peers = {self.user1_id: self.user2_id, self.user2_id: self.user1_id}
+        else:
+            if member_ids is None:
+                member_ids = self.participants.values_list('id', flat=True)
+            peers = {uid: None for uid in member_ids}
+
+        current = set(self.inbox_entries.values_list('user_id', flat=True))
+        self.inbox_entries.exclude(user_id__in=peers).delete()
+        InboxEntry.objects.bulk_create(
+            [
+                InboxEntry(
+                    user_id=uid,
+                    conversation=self,
+                    peer_id=peer_id,
+                    last_activity=self.last_message_time or self.created_at
+                )
+                for uid, peer_id in peers.items()
+            ],
+            ignore_conflicts=True
+        )
+        # Joining or leaving changes the unread totals of only those users
+        UnreadCounter.recount(current.symmetric_difference(peers))
+
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="messages")
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     text = models.TextField()
     is_read = models.BooleanField(default=False)
-    # Tracks which users have read this message (useful for per-user read receipts in groups)
-    read_by = models.ManyToManyField(User, related_name='read_messages', blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Position in the conversation (see Conversation.last_seq)
+    seq = models.PositiveBigIntegerField(default=0)
+    # PersonalMessage this row was backfilled from, if any
+    legacy_id = models.PositiveBigIntegerField(null=True, blank=True, unique=True)
 
     class Meta:
         ordering = ['timestamp']
         indexes = [
             models.Index(fields=['conversation', '-timestamp']),
+            models.Index(fields=['conversation', 'seq']),
         ]
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
 
-        self.conversation.last_message = self.text
-        self.conversation.last_message_time = self.timestamp
-        self.conversation.last_message_sender = self.sender
-        self.conversation.save()
+        with write_transaction():
+            if not self.seq:
+                self.seq = self.conversation.allocate_seqs()
+            super().save(*args, **kwargs)
+            self.conversation.record_last_message(self.sender, self.text, self.timestamp, self.seq)
+            UnreadCounter.add(self.conversation, 1)
+            # Delivered to connected sockets once this transaction commits
+            OutboxEvent.for_message(self).save()
 
     def __str__(self):
         return f"{self.sender.email}: {self.text[:50]}"
@@ -183,12 +294,188 @@ class GroupParticipant(models.Model):
         related_name="group_participants"
     )
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    unread_count = models.PositiveIntegerField(default=0)
     last_read = models.DateTimeField(null=True, blank=True)
+    # Read watermark: every message in the conversation with seq <= this
+    # has been read; the unread count is conversation.last_seq - last_read_seq
+    last_read_seq = models.PositiveBigIntegerField(default=0)
 
     class Meta:
         unique_together = ('conversation', 'user')
+        indexes = [
+            models.Index(fields=['conversation', 'last_read_seq']),
+        ]
 
     def __str__(self):
         return f"{self.user.email} in {self.conversation.name or 'Unnamed Group'}"
 
+
+class InboxEntry(models.Model):
+    """
+    A conversation as it appears in one user's conversation list.
+
+    Only the sort key is denormalized here: previews and read state are on
+    the conversation (and GroupParticipant), which the inbox query joins,
+    so sending a message updates this table with a single statement.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="inbox_entries")
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="inbox_entries")
+    # The other user of a direct conversation (display info for the list)
+    peer = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+    last_activity = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'conversation')
+        indexes = [
+            models.Index(fields=['user', '-last_activity', '-id']),
+        ]
+
+    def __str__(self):
+        return f"{self.user.email}: {self.conversation}"
+
+
+class UnreadCounter(models.Model):
+    """
+    A user's total unread count across direct and group conversations.
+
+    Kept equal to the sum of (last_seq - read seq) over their conversations
+    by applying deltas in the transactions that send and read messages, and
+    recounted from scratch when membership changes. Reads go through the
+    cache, so the badge endpoint is a single key lookup.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="unread_counter")
+    # Signed: a send applies the sender's "read" before the new message's +1
+    total = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user.email}: {self.total} unread"
+
+    @staticmethod
+    def cache_key(user_id):
+        return f"unread:total:{user_id}"
+
+    @classmethod
+    def get_total(cls, user_id):
+        key = cls.cache_key(user_id)
+        total = cache.get(key)
+        if total is None:
+            total = cls.objects.filter(user_id=user_id).values_list('total', flat=True).first() or 0
+            cache.set(key, total, timeout=UNREAD_CACHE_TIMEOUT)
+        return max(total, 0)
+
+    @classmethod
+    def invalidate(cls, user_ids):
+        keys = [cls.cache_key(user_id) for user_id in user_ids]
+        if keys:
+            transaction.on_commit(lambda: cache.delete_many(keys))
+
+    @classmethod
+    def add(cls, conversation, count):
+        """``count`` new messages in ``conversation``: bump every member's total."""
+        if conversation.conversation_type == 'direct':
+            user_ids = [conversation.user1_id, conversation.user2_id]
+        else:
+            user_ids = list(conversation.group_participants.values_list('user_id', flat=True))
+        cls.objects.filter(user_id__in=user_ids).update(total=F('total') + count)
+        cls.invalidate(user_ids)
+
+    @classmethod
+    def add_many(cls, counts):
+        """
+        ``add`` for several conversations at once (``{conversation: count}``).
+        Locks the counters in user id order, so concurrent batches touching
+        the same users cannot deadlock, and writes one UPDATE per distinct
+        increment.
+        """
+        totals = defaultdict(int)
+        group_counts = {}
+        for conversation, count in counts.items():
+            if conversation.conversation_type == 'direct':
+                totals[conversation.user1_id] += count
+                totals[conversation.user2_id] += count
+            else:
+                group_counts[conversation.id] = count
+        for conversation_id, user_id in GroupParticipant.objects.filter(
+            conversation_id__in=group_counts
+        ).values_list('conversation_id', 'user_id'):
+            totals[user_id] += group_counts[conversation_id]
+        if not totals:
+            return
+
+        list(cls.objects.select_for_update().filter(
+            user_id__in=totals
+        ).order_by('user_id').values_list('user_id'))
+        by_increment = defaultdict(list)
+        for user_id, total in totals.items():
+            by_increment[total].append(user_id)
+        for increment, user_ids in sorted(by_increment.items()):
+            cls.objects.filter(user_id__in=user_ids).update(total=F('total') + increment)
+        cls.invalidate(totals)
+
+    @classmethod
+    def subtract(cls, user_id, count):
+        cls.objects.filter(user_id=user_id).update(total=F('total') - count)
+        cls.invalidate([user_id])
+
+    @classmethod
+    def count_for_user(cls, user_id):
+        """Compute a user's total from the read sequences (no counter involved)."""
+        direct = Conversation.objects.filter(
+            Q(user1_id=user_id) | Q(user2_id=user_id),
+            conversation_type='direct'
+        ).aggregate(total=Sum(Case(
+            When(user1_id=user_id, then=F('last_seq') - F('user1_read_seq')),
+            default=F('last_seq') - F('user2_read_seq'),
+        )))['total'] or 0
+        groups = GroupParticipant.objects.filter(
+            user_id=user_id,
+            conversation__conversation_type='group'
+        ).aggregate(total=Sum(F('conversation__last_seq') - F('last_read_seq')))['total'] or 0
+        return direct + groups
+
+    @classmethod
+    def recount(cls, user_ids):
+        user_ids = {user_id for user_id in user_ids if user_id is not None}
+        with write_transaction():
+            # Lock existing rows so in-flight deltas land after the recount
+            list(cls.objects.select_for_update().filter(
+                user_id__in=user_ids
+            ).order_by('user_id').values_list('user_id'))
+            for user_id in sorted(user_ids):
+                cls.objects.update_or_create(
+                    user_id=user_id,
+                    defaults={'total': cls.count_for_user(user_id)}
+                )
+        cls.invalidate(user_ids)
+
+
+class OutboxEvent(models.Model):
+    """
+    A channel-layer event written in the same transaction as the change it
+    announces and relayed by chats.outbox.OutboxDispatcher, so every write
+    path (REST or WebSocket) fans out, at least once, after it commits.
+    """
+    group = models.CharField(max_length=100)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Set while a dispatcher is sending the event; stale claims are retried
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.payload.get('type')} -> {self.group}"
+
+    @classmethod
+    def for_message(cls, message):
+        """Unsaved ``chat_message`` event for ``message`` (id and timestamp must be set)."""
+        return cls(
+            group=f"chat_{message.conversation_id}",  # context.conversation_group_name
+            payload={
+                "type": "chat_message",
+                "message_id": message.id,
+                "seq": message.seq,
+                "message": message.text,
+                "sender_id": message.sender_id,
+                "sender_name": message.sender.get_full_name() or message.sender.email,
+                "timestamp": str(message.timestamp),
+                "conversation_id": message.conversation_id
+            }
+        )
@@ -0,0 +1,195 @@
+"""
+Bounded per-connection send queues.
+
+A socket's frames are queued and written by a task of their own, so a
+slow client no longer stalls its consumer: group events keep being read
+off the channel layer (instead of piling up there until the layer drops
+them silently) and the socket falls behind only in its own queue. The
+queue holds at most ``CHAT_SEND_QUEUE_SIZE`` frames. When it is full:
+
+1. queued typing frames are dropped, and so are new ones (typing state is
+   refreshed by the next typing_state frame anyway);
+2. queued read receipts are merged into one frame per reader (ids) or per
+   conversation (summary);
+3. if that still frees nothing, everything queued is dropped, the client
+   gets a ``reconnect`` frame with the newest seq it was sent per
+   conversation, for ``?last_seq=`` (see chats.replay), and the socket is
+   closed with code 4009:
+
+    {"type": "reconnect", "reason": "Connection too slow",
+     "resume": [{"conversation_id": 7, "last_seq": 42}]}
+
+How far each socket is behind (the age of its oldest queued frame) is
+reported by ``api/metrics/`` under ``sockets.slowest``; the time frames
+spend queued is the ``sockets.send_lag`` timer.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+from .frames import encode
+from .read_receipts import merge_receipt_frames
+
+logger = logging.getLogger(__name__)
+
+SEND_QUEUE_SIZE = getattr(settings, "CHAT_SEND_QUEUE_SIZE", 256)
+SLOW_CONSUMER_CLOSE_CODE = 4009
+
+# Frame kinds: typing is given up first, receipts are merged, the rest is kept
+FRAME = "frame"
+MESSAGE = "message"     # key: (conversation id, seq)
+RECEIPT = "receipt"
+TYPING = "typing"
+_CLOSE = "close"        # key: close code
+
+
+class SendQueue:
+
+    def __init__(self, send, close, user_id, channel_name, max_size=None):
+        self._send = send
+        self._close = close
+        self.user_id = user_id
+        self.channel_name = channel_name
+        self.max_size = max_size if max_size is not None else SEND_QUEUE_SIZE
+        # (kind, key, text, queued at)
+        self.frames = deque()
+        # conversation id -> newest message seq written to the socket
+        self.delivered = {}
+        self.closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        _register(self)
+
+    @property
+    def lag(self):
+        """Seconds the oldest queued frame has been waiting."""
+        try:
+            return time.monotonic() - self.frames[0][3]
+        except IndexError:
+            return 0.0
+
+    def put(self, text, kind=FRAME, key=None):
+        if self.closing:
+            return
+
+        if len(self.frames) >= self.max_size:
+            if kind == TYPING:
+                metrics.increment("sockets.dropped_typing")
+                return
+            self._shed()
+            if len(self.frames) >= self.max_size:
+                self._overflow()
+                return
+
+        self.frames.append((kind, key, text, time.monotonic()))
+        self._wakeup.set()
+
+    def _shed(self):
+        typing = sum(1 for frame in self.frames if frame[0] == TYPING)
+        if typing:
+            self.frames = deque(frame for frame in self.frames if frame[0] != TYPING)
+            metrics.increment("sockets.dropped_typing", typing)
+            return
+
+        receipts = [frame for frame in self.frames if frame[0] == RECEIPT]
+        if len(receipts) < 2:
+            return
+        merged = merge_receipt_frames([frame[2] for frame in receipts])
+        if len(merged) < len(receipts):
+            queued_at = receipts[0][3]
+            self.frames = deque(frame for frame in self.frames if frame[0] != RECEIPT)
+            self.frames.extend((RECEIPT, None, text, queued_at) for text in merged)
+            metrics.increment("sockets.coalesced_receipts", len(receipts) - len(merged))
+
+    def _overflow(self):
+        logger.warning(
+            f"Send queue of user {self.user_id} full ({len(self.frames)} frames, "
+            f"{self.lag:.1f}s behind), disconnecting"
+        )
+        metrics.increment("sockets.slow_disconnects")
+        self.closing = True
+        self.frames.clear()
+        self.frames.append((_CLOSE, SLOW_CONSUMER_CLOSE_CODE, None, time.monotonic()))
+        self._wakeup.set()
+
+    def _resume_hint(self):
+        # Built once the frame being written has gone out, so its seq counts
+        return encode({
+            "type": "reconnect",
+            "reason": "Connection too slow",
+            "resume": [
+                {"conversation_id": conversation_id, "last_seq": seq}
+                for conversation_id, seq in self.delivered.items()
+            ]
+        })
+
+    async def _run(self):
+        try:
+            while True:
+                while not self.frames:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+
+                kind, key, text, queued_at = self.frames.popleft()
+                if kind == _CLOSE:
+                    await self._send(text_data=self._resume_hint())
+                    await self._close(code=key)
+                    return
+
+                await self._send(text_data=text)
+                metrics.observe("sockets.send_lag", time.monotonic() - queued_at)
+
+                if kind == MESSAGE and key[1] is not None:
+                    conversation_id, seq = key
+                    self.delivered[conversation_id] = max(seq, self.delivered.get(conversation_id, seq))
+        except Exception as e:
+            logger.error(f"Error writing to socket of user {self.user_id}: {str(e)}")
+        finally:
+            _unregister(self)
+
+    def stop(self):
+        self._task.cancel()
+        _unregister(self)
+
+
+# Open queues in this process, for the metrics endpoint (another thread)
+_queues_lock = threading.Lock()
+_queues = set()
+
+
+def _register(queue):
+    with _queues_lock:
+        _queues.add(queue)
+
+
+def _unregister(queue):
+    with _queues_lock:
+        _queues.discard(queue)
+
+
+def slowest(limit=10):
+    """The ``limit`` sockets furthest behind, with their queue depth and lag."""
+    with _queues_lock:
+        queues = list(_queues)
+    behind = sorted(
+        ((queue.lag, queue) for queue in queues),
+        key=lambda item: item[0], reverse=True
+    )[:limit]
+    return [
+        {
+            "user_id": queue.user_id,
+            "channel": queue.channel_name,
+            "queued": len(queue.frames),
+            "lag_ms": round(lag * 1000, 3)
+        }
+        for lag, queue in behind if lag > 0
+    ]
+
+
+metrics.register_derived("sockets.slowest", lambda counters: slowest())
@@ -0,0 +1,119 @@
+"""
+Relay of OutboxEvent rows to the channel layer.
+
+Writers insert OutboxEvent rows in the transaction that saves the message,
+so an event exists exactly when its message does. One dispatcher per event
+loop claims pending rows in batches, sends them to their groups and deletes
+them. A process that dies mid-batch leaves its claims to expire and another
+dispatcher re-sends them: delivery is at least once, and clients
+de-duplicate by message id.
+
+Writers in this process call ``wake_dispatchers`` after commit for low
+latency; rows committed elsewhere (other workers) are picked up by polling.
+"""
+
+import asyncio
+import logging
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .db import db_task, per_loop, write_transaction
+from .frames import prepare_outbox_event
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+@write_transaction()
+def claim_events(limit, claim_timeout):
+    """Claim up to ``limit`` pending events, oldest first, for this dispatcher."""
+    now = timezone.now()
+    events = list(
+        OutboxEvent.objects.select_for_update(skip_locked=True).filter(
+            Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - timedelta(seconds=claim_timeout))
+        ).order_by('id')[:limit]
+    )
+    if events:
+        OutboxEvent.objects.filter(id__in=[event.id for event in events]).update(claimed_at=now)
+    return events
+
+
+def delete_events(event_ids):
+    OutboxEvent.objects.filter(id__in=event_ids).delete()
+
+
+class OutboxDispatcher:
+
+    def __init__(self, batch_size=None, poll_interval=None, claim_timeout=None):
+        self.batch_size = (
+            batch_size if batch_size is not None
+            else getattr(settings, "CHAT_OUTBOX_BATCH_SIZE", 500)
+        )
+        self.poll_interval = (
+            poll_interval if poll_interval is not None
+            else getattr(settings, "CHAT_OUTBOX_POLL_INTERVAL", 1.0)
+        )
+        self.claim_timeout = (
+            claim_timeout if claim_timeout is not None
+            else getattr(settings, "CHAT_OUTBOX_CLAIM_TIMEOUT", 30)
+        )
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                # Keep going while full batches come back
+                while await self.dispatch_batch() == self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error(f"Error dispatching outbox events: {str(e)}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch_batch(self):
+        """Send one batch of pending events; returns how many were sent."""
+        events = await db_task(claim_events)(self.batch_size, self.claim_timeout)
+        if not events:
+            return 0
+
+        channel_layer = get_channel_layer()
+        for event in events:
+            await channel_layer.group_send(event.group, prepare_outbox_event(event.payload))
+
+        await db_task(delete_events)([event.id for event in events])
+        return len(events)
+
+
+@per_loop
+def _loop_dispatcher():
+    return OutboxDispatcher()
+
+
+def get_outbox_dispatcher():
+    """Return the dispatcher bound to the running event loop, starting it if needed."""
+    dispatcher = _loop_dispatcher()
+    dispatcher.ensure_running()
+    return dispatcher
+
+
+def wake_dispatchers():
+    """Nudge every dispatcher in this process; safe to call from any thread."""
+    for loop, dispatcher in _loop_dispatcher.instances():
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(dispatcher.wake)
@@ -0,0 +1,126 @@
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination over (timestamp, id) for conversation history.
+
+    Query params (all anchors are message ids):
+        before=<id>   the page of messages just older than the anchor
+        after=<id>    the page of messages just newer than the anchor
+        around=<id>   the anchor with up to half a page on either side,
+                      e.g. to open a chat at the first unread message
+        limit=<n>     page size, capped at max_page_size
+    Without an anchor the newest page is returned. Every page is a range
+    scan over the (conversation, -timestamp) index, so the cost does not
+    depend on how far back the client has scrolled.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    ordering_field = 'timestamp'
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.page_size))
+        except ValueError:
+            raise ValidationError({"limit": "Must be an integer"})
+        return max(1, min(limit, self.max_page_size))
+
+    def get_anchor(self, queryset, request, name):
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+        try:
+            anchor_id = int(value)
+        except ValueError:
+            raise ValidationError({name: "Must be an id"})
+
+        anchor = queryset.filter(id=anchor_id).values(self.ordering_field, 'id').first()
+        if anchor is None:
+            raise NotFound(f"{name} anchor {anchor_id} not found")
+        return anchor
+
+    def older_than(self, queryset, anchor, limit):
+        field = self.ordering_field
+        rows = list(queryset.filter(
+            Q(**{f'{field}__lt': anchor[field]}) |
+            Q(**{field: anchor[field], 'id__lt': anchor['id']})
+        ).order_by(f'-{field}', '-id')[:limit + 1])
+        return rows[:limit][::-1], len(rows) > limit
+
+    def newer_than(self, queryset, anchor, limit):
+        field = self.ordering_field
+        rows = list(queryset.filter(
+            Q(**{f'{field}__gt': anchor[field]}) |
+            Q(**{field: anchor[field], 'id__gt': anchor['id']})
+        ).order_by(field, 'id')[:limit + 1])
+        return rows[:limit], len(rows) > limit
+
+    def paginate_queryset(self, queryset, request, view=None):
+        limit = self.get_limit(request)
+        self.has_older = self.has_newer = False
+
+        around = self.get_anchor(queryset, request, 'around')
+        before = self.get_anchor(queryset, request, 'before')
+        after = self.get_anchor(queryset, request, 'after')
+
+        if around is not None:
+            older, self.has_older = self.older_than(queryset, around, limit // 2)
+            newer, self.has_newer = self.newer_than(queryset, around, limit - len(older) - 1)
+            page = older + list(queryset.filter(id=around['id'])) + newer
+        elif before is not None:
+            page, self.has_older = self.older_than(queryset, before, limit)
+            self.has_newer = True
+        elif after is not None:
+            page, self.has_newer = self.newer_than(queryset, after, limit)
+            self.has_older = True
+        else:
+            rows = list(queryset.order_by(f'-{self.ordering_field}', '-id')[:limit + 1])
+            page, self.has_older = rows[:limit][::-1], len(rows) > limit
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'older_cursor': self.page[0].id if self.page and self.has_older else None,
+            'newer_cursor': self.page[-1].id if self.page and self.has_newer else None,
+        })
+
+
+class InboxCursorPagination(MessageCursorPagination):
+    """
+    Keyset pagination over a user's inbox, most recent conversation first.
+
+    Query params:
+        before=<entry id>   the page after that entry (the next_cursor value)
+        limit=<n>           page size, capped at max_page_size
+    The first page is a single query on the (user, -last_activity, -id) index.
+    """
+
+    ordering_field = 'last_activity'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        limit = self.get_limit(request)
+        before = self.get_anchor(queryset, request, 'before')
+
+        if before is not None:
+            page, self.has_older = self.older_than(queryset, before, limit)
+            page.reverse()
+        else:
+            rows = list(queryset.order_by('-last_activity', '-id')[:limit + 1])
+            page, self.has_older = rows[:limit], len(rows) > limit
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'next_cursor': self.page[-1].id if self.page and self.has_older else None,
+        })
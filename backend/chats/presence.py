@@ -0,0 +1,230 @@
+"""
+Presence: which users have a live socket, pushed to the people who share a
+conversation with them.
+
+Online state lives in the shared cache, not the users table:
+``presence:{id}`` exists while some process has a socket for the user and
+holds the time it was last refreshed. Every process keeps a tracker per
+event loop (like the typing and receipt coalescers) of its sockets, and
+every ``CHAT_PRESENCE_INTERVAL`` it:
+
+- closes sockets that have sent heartbeats but then stayed silent for
+  ``CHAT_PRESENCE_TIMEOUT`` (code 4008); sockets that never sent one are
+  left to the ASGI server's own pings;
+- refreshes its users' keys, which expire after ``CHAT_PRESENCE_TIMEOUT``
+  so the users of a crashed process go offline on their own;
+- marks a user offline once their last local socket has been gone for an
+  interval and no other process has refreshed them since;
+- saves ``is_online``/``last_seen`` for the users that changed, in one
+  batch.
+
+Users coming online are announced as soon as their first socket connects.
+Each change is sent to every conversation of the user:
+
+    {"type": "presence", "conversation_id": 7,
+     "users": [{"user_id": 3, "is_online": false, "last_seen": "..."}]}
+"""
+
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from .context import conversation_group_name
+from .db import db_task, per_loop
+from .frames import encode
+from .models import InboxEntry
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_INTERVAL = getattr(settings, "CHAT_PRESENCE_INTERVAL", 20.0)
+PRESENCE_TIMEOUT = getattr(settings, "CHAT_PRESENCE_TIMEOUT", 60.0)
+
+
+def _presence_key(user_id):
+    return f"presence:{user_id}"
+
+
+def online_status(user_ids):
+    """``{user_id: is online}`` in one cache round trip."""
+    keys = {_presence_key(user_id): user_id for user_id in set(user_ids)}
+    if not keys:
+        return {}
+    found = cache.get_many(keys)
+    return {user_id: key in found for key, user_id in keys.items()}
+
+
+def is_online(user_id):
+    return cache.get(_presence_key(user_id)) is not None
+
+
+def mark_online(user_id):
+    """Returns True if the user was offline everywhere until now."""
+    return cache.add(_presence_key(user_id), time.time(), timeout=PRESENCE_TIMEOUT)
+
+
+def refresh(user_ids):
+    now = time.time()
+    cache.set_many({_presence_key(user_id): now for user_id in user_ids}, timeout=PRESENCE_TIMEOUT)
+
+
+def resolve_offline(gone):
+    """
+    Of ``{user_id: time their last local socket closed}``, return the users
+    no process has refreshed since, and remove their presence.
+    """
+    found = cache.get_many([_presence_key(user_id) for user_id in gone])
+    offline = [
+        user_id for user_id, since in gone.items()
+        if found.get(_presence_key(user_id), 0) < since
+    ]
+    cache.delete_many([_presence_key(user_id) for user_id in offline])
+    return offline
+
+
+def _as_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def save_presence(changes):
+    """Write ``{user_id: (is_online, at)}`` to the users table in one batch."""
+    User = get_user_model()
+    User.objects.bulk_update(
+        [
+            User(id=user_id, is_online=online, last_seen=_as_datetime(at))
+            for user_id, (online, at) in changes.items()
+        ],
+        ['is_online', 'last_seen']
+    )
+
+
+def build_presence_events(changes):
+    """``(group, event)`` pairs: one ``presence`` frame per affected conversation."""
+    by_conversation = defaultdict(list)
+    for user_id, conversation_id in InboxEntry.objects.filter(
+        user_id__in=changes
+    ).values_list('user_id', 'conversation_id'):
+        online, at = changes[user_id]
+        by_conversation[conversation_id].append({
+            "user_id": user_id,
+            "is_online": online,
+            "last_seen": str(_as_datetime(at))
+        })
+
+    return [
+        (conversation_group_name(conversation_id), {
+            "type": "presence_changed",
+            "frame": encode({
+                "type": "presence",
+                "conversation_id": conversation_id,
+                "users": users
+            })
+        })
+        for conversation_id, users in by_conversation.items()
+    ]
+
+
+class PresenceTracker:
+
+    def __init__(self, interval=None, timeout=None):
+        self.interval = interval if interval is not None else PRESENCE_INTERVAL
+        self.timeout = timeout if timeout is not None else PRESENCE_TIMEOUT
+        # user id -> this loop's sockets for the user
+        self.sockets = defaultdict(set)
+        # user id -> when their last socket here closed
+        self.gone = {}
+        # user id -> (is_online, at) not yet written to the database
+        self.unsaved = {}
+        self._task = None
+
+    async def connect(self, consumer):
+        consumer.heartbeats = False
+        self.touch(consumer)
+
+        user_id = consumer.user.id
+        first = not self.sockets[user_id]
+        self.sockets[user_id].add(consumer)
+        self.gone.pop(user_id, None)
+        self._ensure_running()
+
+        if first and await sync_to_async(mark_online, thread_sensitive=False)(user_id):
+            await self.publish({user_id: (True, time.time())})
+
+    def disconnect(self, consumer):
+        user_id = getattr(getattr(consumer, "user", None), "id", None)
+        sockets = self.sockets.get(user_id)
+        if sockets is None or consumer not in sockets:
+            return
+
+        sockets.discard(consumer)
+        if not sockets:
+            del self.sockets[user_id]
+            self.gone[user_id] = time.time()
+
+    @staticmethod
+    def touch(consumer):
+        consumer.last_activity = asyncio.get_running_loop().time()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self.sockets or self.gone or self.unsaved:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping presence: {str(e)}")
+
+    async def sweep(self):
+        # Heartbeating sockets that went silent are dead or stuck
+        silent_since = asyncio.get_running_loop().time() - self.timeout
+        for sockets in list(self.sockets.values()):
+            for consumer in list(sockets):
+                if consumer.heartbeats and consumer.last_activity < silent_since:
+                    logger.info(f"Closing silent socket of user {consumer.user.id}")
+                    self.disconnect(consumer)
+                    await consumer.close(code=4008)
+
+        if self.sockets:
+            await sync_to_async(refresh, thread_sensitive=False)(list(self.sockets))
+
+        # Another process refreshes its users every interval, so by now it
+        # would have refreshed any of these it still has a socket for
+        now = time.time()
+        due = {
+            user_id: since for user_id, since in self.gone.items()
+            if now - since >= self.interval
+        }
+        if due:
+            for user_id in due:
+                del self.gone[user_id]
+            offline = await sync_to_async(resolve_offline, thread_sensitive=False)(due)
+            if offline:
+                await self.publish({user_id: (False, due[user_id]) for user_id in offline})
+
+        if self.unsaved:
+            unsaved, self.unsaved = self.unsaved, {}
+            await db_task(save_presence)(unsaved)
+
+    async def publish(self, changes):
+        self.unsaved.update(changes)
+        self._ensure_running()
+
+        channel_layer = get_channel_layer()
+        for group, event in await db_task(build_presence_events)(changes):
+            await channel_layer.group_send(group, event)
+
+
+@per_loop
+def get_presence_tracker():
+    """Return the tracker bound to the running event loop."""
+    return PresenceTracker()
@@ -0,0 +1,155 @@
+"""
+Token-bucket rate limits for chat events, shared by the socket and REST
+paths.
+
+``CHAT_RATE_LIMITS`` maps an event type to the buckets it draws from, per
+user and/or per conversation, each as ``(tokens per second, burst)``:
+
+    "new_message": {"user": (5, 20), "conversation": (50, 200)}
+
+An event takes one token from each of its buckets, or none at all if any
+of them is empty, in which case the caller learns how long to wait.
+Sockets answer with a "Rate limit exceeded" error frame and drop the
+event, and close with code 4008 once ``CHAT_RATE_LIMIT_MAX_REJECTIONS``
+frames in a row have been rejected; the REST message endpoints answer 429.
+Inbox subscribe and unsubscribe frames draw from the ``subscription``
+buckets. Rejections are counted in chats.metrics as
+``ratelimit.rejected.{event}.{scope}``.
+
+Buckets live in the process by default, so each worker limits its own
+clients. With ``CHAT_RATE_LIMIT_BACKEND = "cache"`` they live in the
+shared Django cache at one round trip per event; updates are read then
+write, so simultaneous events from one user on two workers can both get
+the last token.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+
+RATE_LIMITS = getattr(settings, "CHAT_RATE_LIMITS", {
+    "new_message": {"user": (5, 20), "conversation": (50, 200)},
+    "typing_start": {"user": (2, 10)},
+    "mark_read": {"user": (10, 30)},
+    "subscription": {"user": (2, 20)},
+})
+RATE_LIMIT_BACKEND = getattr(settings, "CHAT_RATE_LIMIT_BACKEND", "local")
+MAX_REJECTIONS = getattr(settings, "CHAT_RATE_LIMIT_MAX_REJECTIONS", 50)
+CLOSE_CODE = 4008
+
+# Least recently used buckets beyond this are forgotten (i.e. refilled)
+LOCAL_MAX_BUCKETS = 100000
+
+
+def _buckets_for(event_type, user_id, conversation_id):
+    """``(scope, key, rate, burst)`` for each bucket the event draws from."""
+    limits = RATE_LIMITS.get(event_type, {})
+    buckets = []
+    for scope, scope_id in (("user", user_id), ("conversation", conversation_id)):
+        if scope in limits and scope_id is not None:
+            rate, burst = limits[scope]
+            buckets.append((scope, f"ratelimit:{event_type}:{scope}:{scope_id}", rate, burst))
+    return buckets
+
+
+def _take(states, buckets, now):
+    """
+    From each bucket's stored ``(tokens, updated)`` (missing when full),
+    return ``(new states, None)``, or ``(None, (scope, wait))`` for the
+    first bucket that is empty.
+    """
+    new_states = {}
+    for scope, key, rate, burst in buckets:
+        state = states.get(key)
+        tokens = burst if state is None else min(burst, state[0] + (now - state[1]) * rate)
+        if tokens < 1:
+            return None, (scope, (1 - tokens) / rate)
+        new_states[key] = (tokens - 1, now)
+    return new_states, None
+
+
+class LocalBuckets:
+
+    def __init__(self, max_size=LOCAL_MAX_BUCKETS):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+
+    def take(self, buckets):
+        now = time.monotonic()
+        with self._lock:
+            new_states, rejected = _take(self._states, buckets, now)
+            if rejected is None:
+                for key, state in new_states.items():
+                    self._states[key] = state
+                    self._states.move_to_end(key)
+                while len(self._states) > self.max_size:
+                    self._states.popitem(last=False)
+        return rejected
+
+
+class CacheBuckets:
+
+    def take(self, buckets):
+        now = time.time()
+        states = cache.get_many([key for _, key, _, _ in buckets])
+        new_states, rejected = _take(states, buckets, now)
+        if rejected is None:
+            # Kept until the slowest bucket would be full again
+            timeout = max(math.ceil(burst / rate) for _, _, rate, burst in buckets)
+            cache.set_many(new_states, timeout=timeout)
+        return rejected
+
+
+_store = CacheBuckets() if RATE_LIMIT_BACKEND == "cache" else LocalBuckets()
+
+
+def take(event_type, user_id=None, conversation_id=None):
+    """
+    Take a token from the user's and/or conversation's buckets for
+    ``event_type``. Returns None if the event may go ahead, otherwise the
+    seconds until it would.
+    """
+    buckets = _buckets_for(event_type, user_id, conversation_id)
+    if not buckets:
+        return None
+
+    rejected = _store.take(buckets)
+    if rejected is None:
+        return None
+    scope, wait = rejected
+    metrics.increment(f"ratelimit.rejected.{event_type}.{scope}")
+    return wait
+
+
+async def take_async(event_type, user_id=None, conversation_id=None):
+    """``take`` from the event loop; cache-backed buckets are taken off it."""
+    if isinstance(_store, CacheBuckets):
+        return await sync_to_async(take, thread_sensitive=False)(event_type, user_id, conversation_id)
+    return take(event_type, user_id, conversation_id)
+
+
+class MessageRateThrottle(BaseThrottle):
+    """
+    The per-user ``new_message`` limit for REST sends. Views check the
+    conversation's bucket themselves once the conversation is resolved
+    and the caller is known to be in it, so outsiders cannot drain it.
+    """
+    event_type = "new_message"
+
+    def allow_request(self, request, view):
+        if not request.user or not request.user.is_authenticated:
+            return True
+        self._wait = take(self.event_type, user_id=request.user.id)
+        return self._wait is None
+
+    def wait(self):
+        return self._wait
@@ -0,0 +1,166 @@
+"""
+Coalesced broadcasting of read receipts.
+
+``mark_read`` frames are merged per conversation over
+``CHAT_RECEIPT_INTERVAL`` and sent as one ``read_summary`` event: for each
+reader, the de-duplicated message ids they marked and the newest of them
+("read up to", since message ids only grow). The event carries the frames
+for every granularity, encoded once, and each socket sends the ones its
+client asked for (see ``ChatConsumer.read_summary``). Storage of read
+state is in chats.receipts.
+"""
+
+import asyncio
+import json
+import logging
+from collections import defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .context import conversation_group_name
+from .db import per_loop
+from .frames import encode
+
+logger = logging.getLogger(__name__)
+
+# Per-connection receipt granularity (?receipts= or a "receipts" frame)
+RECEIPTS_IDS = "ids"            # messages_read frame per reader (default)
+RECEIPTS_SUMMARY = "summary"    # one "read up to" frame per window
+RECEIPTS_NONE = "none"
+RECEIPT_GRANULARITIES = (RECEIPTS_IDS, RECEIPTS_SUMMARY, RECEIPTS_NONE)
+
+
+class ReceiptCoalescer:
+
+    def __init__(self, interval=None):
+        self.interval = (
+            interval if interval is not None
+            else getattr(settings, "CHAT_RECEIPT_INTERVAL", 0.5)
+        )
+        # conversation id -> {reader id: (reader name, set of message ids)}
+        self.pending = defaultdict(dict)
+        self._task = None
+
+    def add(self, conversation_id, reader_id, reader_name, message_ids):
+        readers = self.pending[conversation_id]
+        if reader_id in readers:
+            readers[reader_id][1].update(message_ids)
+        else:
+            readers[reader_id] = (reader_name, set(message_ids))
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing read receipts: {str(e)}")
+
+    async def flush(self):
+        pending, self.pending = self.pending, defaultdict(dict)
+
+        channel_layer = get_channel_layer()
+        for conversation_id, readers in pending.items():
+            readers = [
+                {
+                    "reader_id": reader_id,
+                    "reader_name": reader_name,
+                    "up_to": max(message_ids),
+                    "message_ids": sorted(message_ids)
+                }
+                for reader_id, (reader_name, message_ids) in readers.items()
+            ]
+            await channel_layer.group_send(
+                conversation_group_name(conversation_id),
+                {
+                    "type": "read_summary",
+                    "conversation_id": conversation_id,
+                    "frames": receipt_frames(conversation_id, readers)
+                }
+            )
+
+
+def receipt_frames(conversation_id, readers):
+    """Encoded frames for each granularity (none gets no frames)."""
+    return {
+        RECEIPTS_IDS: [
+            encode({
+                "type": "messages_read",
+                "message_ids": reader["message_ids"],
+                "reader_id": reader["reader_id"],
+                "reader_name": reader["reader_name"],
+                "conversation_id": conversation_id
+            })
+            for reader in readers
+        ],
+        RECEIPTS_SUMMARY: [
+            encode({
+                "type": "messages_read_up_to",
+                "conversation_id": conversation_id,
+                "read_up_to": summarize(readers)
+            })
+        ],
+    }
+
+
+def summarize(readers):
+    """Group readers by the message they have read up to (one entry per reader set)."""
+    by_message = defaultdict(list)
+    for reader in readers:
+        by_message[reader["up_to"]].append(
+            {"user_id": reader["reader_id"], "user_name": reader["reader_name"]}
+        )
+    return [
+        {"message_id": message_id, "readers": by_message[message_id]}
+        for message_id in sorted(by_message)
+    ]
+
+
+def merge_receipt_frames(frames):
+    """
+    Merge encoded receipt frames queued for one socket (see chats.outbound):
+    one messages_read frame per reader, one messages_read_up_to frame per
+    conversation.
+    """
+    by_reader = {}      # (conversation id, reader id) -> messages_read frame
+    up_to = {}          # conversation id -> {reader id: reader}
+    for frame in map(json.loads, frames):
+        conversation_id = frame["conversation_id"]
+        if frame["type"] == "messages_read":
+            key = (conversation_id, frame["reader_id"])
+            if key in by_reader:
+                merged = set(by_reader[key]["message_ids"]) | set(frame["message_ids"])
+                by_reader[key]["message_ids"] = sorted(merged)
+            else:
+                by_reader[key] = frame
+            continue
+
+        readers = up_to.setdefault(conversation_id, {})
+        for entry in frame["read_up_to"]:
+            for reader in entry["readers"]:
+                current = readers.get(reader["user_id"])
+                if current is None or current["up_to"] < entry["message_id"]:
+                    readers[reader["user_id"]] = {
+                        "reader_id": reader["user_id"],
+                        "reader_name": reader["user_name"],
+                        "up_to": entry["message_id"]
+                    }
+
+    return [encode(frame) for frame in by_reader.values()] + [
+        encode({
+            "type": "messages_read_up_to",
+            "conversation_id": conversation_id,
+            "read_up_to": summarize(list(readers.values()))
+        })
+        for conversation_id, readers in up_to.items()
+    ]
+
+
+@per_loop
+def get_receipt_coalescer():
+    """Return the coalescer bound to the running event loop."""
+    return ReceiptCoalescer()
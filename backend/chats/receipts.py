@@ -0,0 +1,77 @@
+"""
+Group read receipts answered from per-participant read watermarks.
+
+A GroupParticipant's ``last_read_seq`` is both their unread count
+(``conversation.last_seq - last_read_seq``) and their read watermark:
+message seqs grow monotonically within a conversation, so "has user U read
+message X" is simply ``last_read_seq(U) >= X.seq``. There is no second
+watermark to drift from it. A receipt is one UPDATE no matter how many
+messages it covers, and storage is one row per member instead of one per
+(message, reader).
+"""
+
+from bisect import bisect_left
+
+from django.contrib.auth import get_user_model
+from django.db.models import Max
+
+from .db import write_transaction
+from .models import Conversation, GroupParticipant, Message
+
+User = get_user_model()
+
+
+def advance_watermark(conversation_id, user, message_ids):
+    """
+    Move ``user``'s watermark up to the newest of ``message_ids`` in the
+    conversation (through ``Conversation.advance_read_seq``, so the unread
+    counter follows). Watermarks never move backwards. Returns the new
+    watermark seq, or None if nothing changed.
+    """
+    with write_transaction():
+        newest = Message.objects.filter(
+            id__in=message_ids,
+            conversation_id=conversation_id
+        ).aggregate(newest=Max('seq'))['newest']
+        if newest is None:
+            return None
+
+        conversation = Conversation.objects.get(id=conversation_id)
+        if conversation.advance_read_seq(user, newest):
+            return newest
+        return None
+
+
+def readers_of(message):
+    """Users (other than the sender) who have read ``message``."""
+    return User.objects.filter(
+        groupparticipant__conversation_id=message.conversation_id,
+        groupparticipant__last_read_seq__gte=message.seq
+    ).exclude(id=message.sender_id)
+
+
+def read_counts(conversation_id, messages):
+    """
+    Map message id -> number of readers (excluding the sender) for a page of
+    messages, from a single range query over the watermark index.
+    """
+    messages = list(messages)
+    if not messages:
+        return {}
+
+    oldest = min(message.seq for message in messages)
+    watermarks = dict(
+        GroupParticipant.objects.filter(
+            conversation_id=conversation_id,
+            last_read_seq__gte=oldest
+        ).values_list('user_id', 'last_read_seq')
+    )
+    ordered = sorted(watermarks.values())
+
+    counts = {}
+    for message in messages:
+        count = len(ordered) - bisect_left(ordered, message.seq)
+        if watermarks.get(message.sender_id, 0) >= message.seq:
+            count -= 1
+        counts[message.id] = count
+    return counts
@@ -0,0 +1,113 @@
+"""
+Replay of the messages a socket missed while it was disconnected.
+
+Clients remember the ``seq`` of the newest message they have seen and send
+it back on reconnect (``?last_seq=`` on the socket URL, or a ``resume``
+frame). Missed messages are a range scan on the (conversation, seq) index,
+so a reconnect costs O(missed messages) rather than O(history). Past
+``CHAT_RESUME_MAX_MESSAGES`` the client is told to reload the newest REST
+page instead.
+"""
+
+from django.conf import settings
+
+from .models import Conversation, GroupParticipant, Message
+
+RESUME_MAX_MESSAGES = getattr(settings, "CHAT_RESUME_MAX_MESSAGES", 200)
+
+
+class ResumeOverflow(Exception):
+    """More messages were missed than a replay may carry."""
+
+
+def parse_cursor(params):
+    """
+    Return ``("last_seq" | "last_message_id", value)`` from a frame or
+    query-string dict, or None if neither is given (or not an integer).
+    """
+    for key in ("last_seq", "last_message_id"):
+        value = params.get(key)
+        if value is None:
+            continue
+        try:
+            return key, int(value)
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def message_frame(message):
+    """A missed message, in the same shape as the live ``new_message`` frame."""
+    return {
+        "type": "new_message",
+        "id": message.id,
+        "seq": message.seq,
+        "message": message.text,
+        "sender_id": message.sender_id,
+        "sender_name": message.sender.get_full_name() or message.sender.email,
+        "timestamp": str(message.timestamp),
+        "conversation_id": message.conversation_id
+    }
+
+
+def receipt_frames(context, user, missed):
+    """``messages_read`` frames for the missed messages other members have read."""
+    if context.is_direct:
+        conversation = Conversation.objects.select_related('user1', 'user2').get(
+            id=context.conversation_id
+        )
+        if user.id == conversation.user1_id:
+            peer, peer_read_seq = conversation.user2, conversation.user2_read_seq
+        else:
+            peer, peer_read_seq = conversation.user1, conversation.user1_read_seq
+        readers = [(peer, lambda message: message.seq <= peer_read_seq)]
+    else:
+        participants = GroupParticipant.objects.filter(
+            conversation_id=context.conversation_id,
+            last_read_seq__gte=missed[0].seq
+        ).exclude(user=user).select_related('user')
+        readers = [
+            (participant.user,
+             lambda message, watermark=participant.last_read_seq: message.seq <= watermark)
+            for participant in participants
+        ]
+
+    frames = []
+    for reader, has_read in readers:
+        message_ids = [
+            message.id for message in missed
+            if message.sender_id != reader.id and has_read(message)
+        ]
+        if message_ids:
+            frames.append({
+                "type": "messages_read",
+                "message_ids": message_ids,
+                "reader_id": reader.id,
+                "reader_name": reader.get_full_name() or reader.email,
+                "conversation_id": context.conversation_id
+            })
+    return frames
+
+
+def load_replay(context, user, cursor):
+    """
+    Frames replaying what ``user`` missed in the context's conversation
+    after ``cursor`` (see ``parse_cursor``), oldest first, followed by the
+    read receipts for those messages. Raises ResumeOverflow past the cap,
+    and Message.DoesNotExist for an unknown ``last_message_id``.
+    """
+    messages = Message.objects.filter(conversation_id=context.conversation_id)
+
+    key, value = cursor
+    if key == "last_message_id":
+        value = messages.values_list('seq', flat=True).get(id=value)
+
+    missed = list(
+        messages.filter(seq__gt=value).select_related('sender').order_by('seq')[:RESUME_MAX_MESSAGES + 1]
+    )
+    if len(missed) > RESUME_MAX_MESSAGES:
+        raise ResumeOverflow()
+    if not missed:
+        return []
+
+    return [message_frame(message) for message in missed] + receipt_frames(context, user, missed)
@@ -10,14 +10,22 @@ Endpoints:
         - Real-time chat messages for a specific conversation
         - Supports direct messages and group chats
         - Handles typing indicators and read receipts
+
+    /ws/inbox/
+        - One connection per user, multiplexing many conversations
+        - Subscribe/unsubscribe with in-band frames; events carry conversation_id
 """
 
 from django.urls import path
-from .consumers import ChatConsumer
+from .consumers import ChatConsumer, InboxConsumer
 
 websocket_urlpatterns = [
     # Chat WebSocket endpoint - supports conversation messaging, typing, and read receipts
     # Accepts both with and without trailing slash
     path('ws/chat/<int:conversation_id>/', ChatConsumer.as_asgi(), name='ws-chat'),
     path('ws/chat/<int:conversation_id>', ChatConsumer.as_asgi()),
+
+    # Inbox WebSocket endpoint - one socket subscribes to many conversations
+    path('ws/inbox/', InboxConsumer.as_asgi(), name='ws-inbox'),
+    path('ws/inbox', InboxConsumer.as_asgi()),
 ]
@@ -1,15 +1,41 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from django.db.models import Q
-from .models import PersonalMessage, Message, Conversation
+from .models import PersonalMessage, Message, Conversation, InboxEntry
+from . import presence
+
+
+def online_context(context, user_ids):
+    """Look up presence for ``user_ids`` once and keep it for ``is_online``."""
+    context.setdefault('online', {}).update(presence.online_status(user_ids))
+    return context
+
+
+class PresenceListSerializer(serializers.ListSerializer):
+    """Fetches presence for the whole list in one cache round trip."""
+
+    def to_representation(self, data):
+        users = list(data.all() if hasattr(data, 'all') else data)
+        online_context(self.context, [user.id for user in users])
+        return super().to_representation(users)
+
 
 class UserGetSerializer(serializers.ModelSerializer):
+    # Live presence (chats.presence); the stored column lags by an interval
+    is_online = serializers.SerializerMethodField()
+
     class Meta:
         model= get_user_model()
         fields =['email', 'first_name','last_name','id','image_url','description','is_online','last_seen']
         extra_kwargs = {
             'id':{'read_only':True}
         }
+        list_serializer_class = PresenceListSerializer
+
+    def get_is_online(self, obj):
+        online = self.context.get('online', {})
+        if obj.id in online:
+            return online[obj.id]
+        return presence.is_online(obj.id)
 
 class PersonalMessageSerializer(serializers.ModelSerializer):
     sender_email = serializers.EmailField(source='sender.email', read_only=True)
@@ -33,18 +59,59 @@ class PersonalMessageSerializer(serializers.ModelSerializer):
         return obj.receiver.get_full_name() or obj.receiver.email
 
 
+class DirectMessageSerializer(serializers.ModelSerializer):
+    """Direct-chat Message rows, in the PersonalMessage response shape."""
+    sender_email = serializers.EmailField(source='sender.email', read_only=True)
+    sender_name = serializers.SerializerMethodField()
+    receiver = serializers.SerializerMethodField()
+    receiver_email = serializers.SerializerMethodField()
+    receiver_name = serializers.SerializerMethodField()
+    message = serializers.CharField(source='text', read_only=True)
+
+    class Meta:
+        model = Message
+        fields = [
+            'id', 'sender', 'sender_email', 'sender_name',
+            'receiver', 'receiver_email', 'receiver_name',
+            'message', 'timestamp', 'is_read'
+        ]
+        read_only_fields = ['id', 'timestamp', 'sender', 'is_read']
+
+    def _receiver(self, obj):
+        conversation = obj.conversation
+        return conversation.user2 if obj.sender_id == conversation.user1_id else conversation.user1
+
+    def get_sender_name(self, obj):
+        return obj.sender.get_full_name() or obj.sender.email
+
+    def get_receiver(self, obj):
+        return self._receiver(obj).id
+
+    def get_receiver_email(self, obj):
+        return self._receiver(obj).email
+
+    def get_receiver_name(self, obj):
+        receiver = self._receiver(obj)
+        return receiver.get_full_name() or receiver.email
+
+
 class MessageSerializer(serializers.ModelSerializer):
     sender_id = serializers.IntegerField(source='sender.id', read_only=True)
     sender_name = serializers.SerializerMethodField()
+    read_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ['id', 'sender_id', 'sender_name', 'text', 'is_read', 'timestamp']
+        fields = ['id', 'sender_id', 'sender_name', 'text', 'is_read', 'read_count', 'timestamp']
         read_only_fields = ['id', 'timestamp', 'is_read']
 
     def get_sender_name(self, obj):
         return obj.sender.get_full_name() or obj.sender.email
 
+    def get_read_count(self, obj):
+        # Filled in by views that computed receipts for the page (see chats.receipts)
+        return self.context.get('read_counts', {}).get(obj.id)
+
 class ConversationSerializer(serializers.ModelSerializer):
     other_user = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
@@ -76,7 +143,7 @@ class ConversationSerializer(serializers.ModelSerializer):
                     other = obj.user2
                 else:
                     other = obj.user1
-                return UserGetSerializer(other).data
+                return UserGetSerializer(other, context=self.context).data
         return None
 
     def get_last_message(self, obj):
@@ -98,15 +165,14 @@ class ConversationSerializer(serializers.ModelSerializer):
             if not request or request.user not in [obj.user1, obj.user2]:
                 return []
 
-            msgs = PersonalMessage.objects.filter(
-                (Q(sender=obj.user1) & Q(receiver=obj.user2)) |
-                (Q(sender=obj.user2) & Q(receiver=obj.user1))
+            msgs = obj.messages.select_related(
+                'sender', 'conversation__user1', 'conversation__user2'
             ).order_by('timestamp')
 
-            return PersonalMessageSerializer(msgs, many=True, context={'request': request}).data
+            return DirectMessageSerializer(msgs, many=True, context={'request': request}).data
 
         # For groups, return Message objects (group messages)
-        msgs = obj.messages.order_by('timestamp')
+        msgs = obj.messages.select_related('sender').order_by('timestamp')
         return MessageSerializer(msgs, many=True, context={'request': request}).data
 
 class ChatListSerializer(serializers.Serializer):
@@ -144,7 +210,7 @@ class ConversationListSerializer(serializers.ModelSerializer):
                     other=obj.user2
                 else:
                     other=obj.user1
-                return UserGetSerializer(other).data
+                return UserGetSerializer(other, context=self.context).data
         return None
     
     def get_last_message(self,obj):
@@ -157,4 +223,29 @@ class ConversationListSerializer(serializers.ModelSerializer):
                                or obj.last_message_sender.email if obj.last_message_sender else 'Unknown'
             }
         return None
-        return None
\ No newline at end of file
+        return None
+
+
+class InboxEntrySerializer(serializers.ModelSerializer):
+    conversation_id = serializers.IntegerField(source='conversation.id', read_only=True)
+    conversation_type = serializers.CharField(source='conversation.conversation_type', read_only=True)
+    name = serializers.SerializerMethodField()
+    user = UserGetSerializer(source='peer', read_only=True)
+    last_message = serializers.CharField(source='conversation.last_message', read_only=True)
+    last_message_time = serializers.DateTimeField(source='conversation.last_message_time', read_only=True)
+    last_message_sender_id = serializers.IntegerField(source='conversation.last_message_sender_id', read_only=True)
+    # Annotated by the inbox query: last_seq - the user's read seq
+    unread_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = InboxEntry
+        fields = [
+            'id', 'conversation_id', 'conversation_type', 'name', 'user',
+            'last_message', 'last_message_time', 'last_message_sender_id',
+            'unread_count'
+        ]
+
+    def get_name(self, obj):
+        if obj.peer:
+            return obj.peer.get_full_name().strip() or obj.peer.email
+        return obj.conversation.name
@@ -0,0 +1,45 @@
+"""
+Initial state sent to a socket right after it connects (``?snapshot=1``).
+
+Everything a chat screen needs to render, in one frame and a fixed number
+of queries (at most four): the conversation, its newest messages, the
+participants with their online status and the caller's unread count.
+"""
+
+from django.conf import settings
+
+from .models import Conversation
+from .replay import message_frame
+from .serializers import UserGetSerializer
+
+SNAPSHOT_MESSAGES = getattr(settings, "CHAT_SNAPSHOT_MESSAGES", 50)
+
+
+def build_snapshot(context, user):
+    conversation = Conversation.objects.select_related('user1', 'user2').get(
+        id=context.conversation_id
+    )
+
+    rows = list(
+        conversation.messages.select_related('sender').order_by('-seq')[:SNAPSHOT_MESSAGES + 1]
+    )
+    messages = rows[:SNAPSHOT_MESSAGES][::-1]
+
+    if context.is_direct:
+        participants = [conversation.user1, conversation.user2]
+        unread = conversation.get_unread_count_for_user(user)
+    else:
+        participants = conversation.participants.all()
+        unread = conversation.get_group_unread_count(user)
+
+    return {
+        "type": "snapshot",
+        "conversation_id": conversation.id,
+        "conversation_type": conversation.conversation_type,
+        "name": conversation.name,
+        "messages": [message_frame(message) for message in messages],
+        # Older history is on the REST endpoint (before=<oldest id>)
+        "has_more": len(rows) > SNAPSHOT_MESSAGES,
+        "unread_count": unread,
+        "participants": UserGetSerializer(participants, many=True).data,
+    }
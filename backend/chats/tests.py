@@ -1,3 +1,497 @@
-from django.test import TestCase
+import asyncio
+import io
+import random
+from collections import defaultdict
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from .layers import HashRing, ShardedRedisChannelLayer
+from .models import Conversation, Message, OutboxEvent, PersonalMessage, UnreadCounter
+from .pagination import MessageCursorPagination
+from .writer import MessageWriter, PendingMessage, persist_batch
+
+User = get_user_model()
+
+# The configured cache is Redis; tests keep theirs in the process
+LOCAL_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class FakeRedis:
+    """In-memory stand-in for the Redis commands rebalance() uses."""
+
+    def __init__(self):
+        self.sorted_sets = defaultdict(dict)
+        self.expiries = {}
+
+    async def scan_iter(self, match, count=None):
+        prefix = match.rstrip(b"*")
+        for key in list(self.sorted_sets):
+            if key.startswith(prefix):
+                yield key
+
+    async def zrange(self, key, start, end, withscores=False):
+        members = sorted(self.sorted_sets.get(key, {}).items(), key=lambda item: item[1])
+        return members if withscores else [member for member, _ in members]
+
+    async def zadd(self, key, mapping, gt=False):
+        members = self.sorted_sets[key]
+        for member, score in mapping.items():
+            if not gt or member not in members or score > members[member]:
+                members[member] = score
+
+    async def expire(self, key, seconds):
+        self.expiries[key] = seconds
+
+    async def delete(self, key):
+        self.sorted_sets.pop(key, None)
+        self.expiries.pop(key, None)
+
+
+def sharded_layer(host_count, shards=None):
+    layer = ShardedRedisChannelLayer(
+        hosts=[f"redis://127.0.0.1:{6379 + index}" for index in range(host_count)]
+    )
+    if shards is not None:
+        layer.connection = lambda index: shards[index]
+    return layer
+
+
+class HashRingTests(SimpleTestCase):
+
+    def test_adding_a_node_moves_about_one_nth_of_keys(self):
+        nodes = [f"redis-{index}:6379" for index in range(4)]
+        before = HashRing(nodes)
+        after = HashRing(nodes + ["redis-4:6379"])
+
+        keys = [f"chat_{index}" for index in range(5000)] + [f"user_{index}" for index in range(5000)]
+        moved = [key for key in keys if before.lookup(key) != after.lookup(key)]
+
+        # Ideal is 1/5; virtual points keep it close
+        self.assertAlmostEqual(len(moved) / len(keys), 1 / 5, delta=0.05)
+        # Keys only ever move to the new node
+        self.assertEqual({after.lookup(key) for key in moved}, {4})
+
+
+class ShardedRedisChannelLayerTests(SimpleTestCase):
+
+    def test_send_and_receive_hash_process_channels_alike(self):
+        layer = sharded_layer(4)
+        shards = set()
+        for _ in range(200):
+            channel = f"specific.{layer.client_prefix}!{random.getrandbits(64):x}"
+            shard = layer.consistent_hash(channel)
+            self.assertEqual(shard, layer.consistent_hash(layer.non_local_name(channel)))
+            shards.add(shard)
+        # Different processes still spread over the hosts
+        for prefix in range(50):
+            shards.add(layer.consistent_hash(f"specific.process{prefix}!"))
+        self.assertGreater(len(shards), 1)
+
+    async def test_rebalance_moves_groups_to_their_new_owner(self):
+        shards = [FakeRedis() for _ in range(3)]
+        old = sharded_layer(2, shards)
+        groups = [f"chat_{index}" for index in range(200)]
+        for group in groups:
+            owner = shards[old.consistent_hash(group)]
+            await owner.zadd(old._group_key(group), {b"specific.a!1": 1.0, b"specific.b!2": 2.0})
+
+        new = sharded_layer(3, shards)
+        expected = {group for group in groups if new.consistent_hash(group) != old.consistent_hash(group)}
+        self.assertTrue(expected)
+
+        self.assertEqual(set(await new.rebalance(dry_run=True)), expected)
+        self.assertFalse(shards[2].sorted_sets)
+
+        self.assertEqual(set(await new.rebalance()), expected)
+        for group in groups:
+            key = new._group_key(group)
+            owner = new.consistent_hash(group)
+            for index, shard in enumerate(shards):
+                self.assertEqual(key in shard.sorted_sets, index == owner, group)
+            self.assertEqual(
+                await shards[owner].zrange(key, 0, -1, withscores=True),
+                [(b"specific.a!1", 1.0), (b"specific.b!2", 2.0)]
+            )
+            if group in expected:
+                self.assertEqual(shards[owner].expiries[key], new.group_expiry)
+
+        self.assertEqual(await new.rebalance(), [])
+
+    async def test_rebalance_keeps_newer_join_times(self):
+        shards = [FakeRedis() for _ in range(3)]
+        layer = sharded_layer(3, shards)
+        group = next(
+            f"user_{index}" for index in range(1000)
+            if layer.consistent_hash(f"user_{index}") != 0
+        )
+        key = layer._group_key(group)
+        owner = shards[layer.consistent_hash(group)]
+        await shards[0].zadd(key, {b"specific.a!1": 5.0, b"specific.b!2": 5.0})
+        # Re-joined on the new owner since
+        await owner.zadd(key, {b"specific.a!1": 9.0})
+
+        await layer.rebalance()
+
+        self.assertNotIn(key, shards[0].sorted_sets)
+        self.assertEqual(owner.sorted_sets[key], {b"specific.a!1": 9.0, b"specific.b!2": 5.0})
+
+
+def create_users(count):
+    return [User.objects.create_user(email=f"user{index}@example.com") for index in range(count)]
+
+
+def create_group(members):
+    group = Conversation.objects.create(name="group", conversation_type='group', created_by=members[0])
+    group.participants.set(members)
+    group.sync_group_participants()
+    return group
+
+
+def stored_total(user):
+    """
+    The counter row itself (the cached copy is only cleared on commit);
+    users get one with their first conversation.
+    """
+    return UnreadCounter.objects.filter(user=user).values_list('total', flat=True).first() or 0
+
+
+def pending(sender, conversation, text):
+    return PendingMessage(sender, getattr(conversation, "id", conversation), text, future=None)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class PersistBatchTests(TestCase):
+
+    def setUp(self):
+        self.users = create_users(3)
+        self.direct, _ = Conversation.get_or_create_direct(self.users[0], self.users[1])
+        self.group = create_group(self.users)
+
+    def test_batch_allocates_consecutive_seqs_per_conversation(self):
+        alice, bob, carol = self.users
+        with self.assertLogs("chats.writer", "ERROR"):
+            results = persist_batch([
+                pending(alice, self.group, "g1"),
+                pending(bob, self.direct, "d1"),
+                pending(bob, self.group, "g2"),
+                pending(alice, 999999, "nowhere"),
+                pending(carol, self.group, "g3"),
+            ])
+
+        self.assertIsNone(results[3])
+        self.assertEqual(
+            [(message.conversation_id, message.seq, message.text) for message in results if message],
+            [(self.group.id, 1, "g1"), (self.direct.id, 1, "d1"),
+             (self.group.id, 2, "g2"), (self.group.id, 3, "g3")]
+        )
+        self.assertTrue(all(message.pk for message in results if message))
+        self.assertEqual(OutboxEvent.objects.count(), 4)
+
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.last_seq, 3)
+        self.assertEqual((self.group.last_message, self.group.last_message_sender_id), ("g3", carol.id))
+
+        # A later batch continues where this one stopped
+        later = persist_batch([pending(alice, self.group, "g4")])
+        self.assertEqual(later[0].seq, 4)
+
+    def test_senders_read_their_own_messages_and_counters_match(self):
+        alice, bob, carol = self.users
+        persist_batch([
+            pending(alice, self.group, "g1"),
+            pending(bob, self.group, "g2"),
+            pending(bob, self.direct, "d1"),
+            pending(alice, self.group, "g3"),
+        ])
+
+        # Each sender has read up to their own newest message in the batch
+        participants = dict(self.group.group_participants.values_list('user_id', 'last_read_seq'))
+        self.assertEqual(participants, {alice.id: 3, bob.id: 2, carol.id: 0})
+        for user in self.users:
+            self.assertEqual(stored_total(user), UnreadCounter.count_for_user(user.id), user.email)
+        self.assertEqual(stored_total(alice), 1)
+        self.assertEqual(stored_total(carol), 3)
+
+
+class MessageWriterTests(SimpleTestCase):
+    """Batching only: persist_batch is replaced, so no database is involved."""
+
+    def setUp(self):
+        self.batches = []
+
+        def persist(batch):
+            self.batches.append([entry.text for entry in batch])
+            return [None] * len(batch)
+
+        for patcher in (
+            mock.patch("chats.writer.persist_batch", persist),
+            mock.patch("chats.writer.get_outbox_dispatcher"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_messages_within_the_window_share_a_batch(self):
+        writer = MessageWriter(batch_window=0.05, max_batch_size=100)
+        results = await asyncio.gather(*(writer.submit(None, 1, f"m{index}") for index in range(5)))
+
+        self.assertEqual(results, [None] * 5)
+        self.assertEqual(self.batches, [["m0", "m1", "m2", "m3", "m4"]])
+
+    async def test_batches_are_capped_in_submit_order(self):
+        writer = MessageWriter(batch_window=0.05, max_batch_size=2)
+        await asyncio.gather(*(writer.submit(None, 1, f"m{index}") for index in range(5)))
+
+        self.assertEqual(self.batches, [["m0", "m1"], ["m2", "m3"], ["m4"]])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SequenceTests(TestCase):
+
+    def setUp(self):
+        self.users = create_users(3)
+        self.direct, _ = Conversation.get_or_create_direct(self.users[0], self.users[1])
+        self.group = create_group(self.users)
+
+    def send(self, conversation, sender, text="hi"):
+        return Message.objects.create(conversation=conversation, sender=sender, text=text)
+
+    def test_sends_take_consecutive_seqs_per_conversation(self):
+        alice, bob, _ = self.users
+        seqs = [
+            self.send(self.group, alice).seq,
+            self.send(self.direct, bob).seq,
+            self.send(self.group, bob).seq,
+            self.send(self.direct, alice).seq,
+        ]
+        self.assertEqual(seqs, [1, 1, 2, 2])
+
+        self.group.refresh_from_db()
+        self.direct.refresh_from_db()
+        self.assertEqual((self.group.last_seq, self.direct.last_seq), (2, 2))
+
+    def test_unread_counts_follow_read_seqs(self):
+        alice, bob, carol = self.users
+        for _ in range(3):
+            self.send(self.group, alice)
+        self.send(self.direct, alice)
+        self.group.refresh_from_db()
+        self.direct.refresh_from_db()
+
+        # The sender has read their own messages
+        self.assertEqual(self.group.get_group_unread_count(alice), 0)
+        self.assertEqual(self.group.get_group_unread_count(bob), 3)
+        self.assertEqual(self.direct.get_unread_count_for_user(bob), 1)
+
+        self.assertEqual(self.group.advance_read_seq(bob, 2), 2)
+        self.assertEqual(self.group.get_group_unread_count(bob), 1)
+        # Never moves back, and never past the newest message
+        self.assertEqual(self.group.advance_read_seq(bob, 1), 0)
+        self.assertEqual(self.group.advance_read_seq(carol, 99), 3)
+        self.assertEqual(self.group.get_group_unread_count(carol), 0)
+
+        self.direct.reset_unread_for_user(bob)
+        self.direct.refresh_from_db()
+        self.assertEqual(self.direct.get_unread_count_for_user(bob), 0)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class UnreadCounterTests(TestCase):
+
+    def setUp(self):
+        self.users = create_users(4)
+        self.direct, _ = Conversation.get_or_create_direct(self.users[0], self.users[1])
+        self.group = create_group(self.users[:3])
+
+    def assertCountersMatch(self):
+        for user in self.users:
+            self.assertEqual(stored_total(user), UnreadCounter.count_for_user(user.id), user.email)
+
+    def test_sends_and_reads_keep_counters_in_step(self):
+        alice, bob, carol, _ = self.users
+        for sender in (alice, bob, alice):
+            Message.objects.create(conversation=self.group, sender=sender, text="hi")
+        Message.objects.create(conversation=self.direct, sender=bob, text="hi")
+        self.assertCountersMatch()
+        self.assertEqual([stored_total(user) for user in self.users], [1, 1, 3, 0])
+
+        self.group.refresh_from_db()
+        self.group.advance_read_seq(carol, 1)
+        self.group.reset_group_unread_for_user(alice)
+        self.direct.refresh_from_db()
+        self.direct.reset_unread_for_user(alice)
+        self.assertCountersMatch()
+        self.assertEqual([stored_total(user) for user in self.users], [0, 1, 2, 0])
+
+    def test_add_many_matches_per_conversation_adds(self):
+        UnreadCounter.add_many({self.group: 2, self.direct: 3})
+        self.assertEqual([stored_total(user) for user in self.users], [5, 5, 2, 0])
+
+    def test_recount_repairs_drift(self):
+        alice, bob, carol, dave = self.users
+        Message.objects.create(conversation=self.group, sender=alice, text="hi")
+        UnreadCounter.objects.filter(user__in=[bob, carol]).update(total=42)
+
+        UnreadCounter.recount([bob.id, carol.id, dave.id, None])
+        self.assertCountersMatch()
+        self.assertEqual(stored_total(bob), 1)
+
+    def test_joining_and_leaving_recount_the_member(self):
+        alice, _, _, dave = self.users
+        Message.objects.create(conversation=self.group, sender=alice, text="hi")
+
+        self.group.participants.add(dave)
+        self.group.sync_group_participants()
+        self.assertCountersMatch()
+        self.assertEqual(stored_total(dave), 1)
+
+        self.group.participants.remove(dave)
+        self.group.sync_group_participants()
+        self.assertCountersMatch()
+        self.assertEqual(stored_total(dave), 0)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class MessageCursorPaginationTests(TestCase):
+
+    def setUp(self):
+        alice, bob = create_users(2)
+        self.conversation, _ = Conversation.get_or_create_direct(alice, bob)
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, sender=alice, text=f"m{index}")
+            for index in range(10)
+        ]
+        self.ids = [message.id for message in self.messages]
+
+    def page(self, **params):
+        paginator = MessageCursorPagination()
+        request = Request(APIRequestFactory().get("/", params))
+        page = paginator.paginate_queryset(self.conversation.messages.all(), request)
+        return [message.id for message in page], paginator.get_paginated_response([]).data
+
+    def test_newest_page_without_anchor(self):
+        ids, data = self.page(limit=3)
+        self.assertEqual(ids, self.ids[-3:])
+        self.assertEqual((data['older_cursor'], data['newer_cursor']), (self.ids[-3], None))
+
+    def test_before_walks_back_to_the_first_message(self):
+        ids, data = self.page(before=self.ids[3], limit=2)
+        self.assertEqual(ids, self.ids[1:3])
+        self.assertEqual((data['older_cursor'], data['newer_cursor']), (self.ids[1], self.ids[2]))
+
+        ids, data = self.page(before=self.ids[1], limit=2)
+        self.assertEqual(ids, self.ids[:1])
+        self.assertIsNone(data['older_cursor'])
+
+    def test_after_walks_forward_to_the_newest_message(self):
+        ids, data = self.page(after=self.ids[5], limit=3)
+        self.assertEqual(ids, self.ids[6:9])
+        self.assertEqual(data['newer_cursor'], self.ids[8])
+
+        ids, data = self.page(after=self.ids[8], limit=3)
+        self.assertEqual(ids, self.ids[9:])
+        self.assertIsNone(data['newer_cursor'])
+
+    def test_around_centers_the_anchor(self):
+        ids, data = self.page(around=self.ids[5], limit=5)
+        self.assertEqual(ids, self.ids[3:8])
+        self.assertEqual((data['older_cursor'], data['newer_cursor']), (self.ids[3], self.ids[7]))
+
+        # Near the start the remainder of the page goes after the anchor
+        ids, _ = self.page(around=self.ids[0], limit=5)
+        self.assertEqual(ids, self.ids[:5])
+
+    def test_equal_timestamps_are_ordered_by_id(self):
+        Message.objects.filter(id__in=self.ids).update(timestamp=self.messages[0].timestamp)
+        self.assertEqual(self.page(before=self.ids[6], limit=3)[0], self.ids[3:6])
+        self.assertEqual(self.page(after=self.ids[6], limit=3)[0], self.ids[7:10])
+
+    def test_bad_anchors_are_rejected(self):
+        with self.assertRaises(ValidationError):
+            self.page(before="latest")
+        with self.assertRaises(NotFound):
+            self.page(before=max(self.ids) + 1000)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BackfillDirectMessagesTests(TestCase):
+
+    def setUp(self):
+        self.alice, self.bob, self.carol = create_users(3)
+
+    def legacy(self, sender, receiver, text, is_read=False):
+        return PersonalMessage.objects.create(sender=sender, receiver=receiver, message=text, is_read=is_read)
+
+    def backfill(self, **options):
+        out = io.StringIO()
+        call_command("backfill_direct_messages", stdout=out, **options)
+        return out.getvalue()
+
+    def test_copies_history_into_new_conversations(self):
+        rows = [
+            self.legacy(self.alice, self.bob, "a1", is_read=True),
+            self.legacy(self.bob, self.alice, "b1"),
+            self.legacy(self.alice, self.carol, "c1"),
+            self.legacy(self.alice, self.bob, "a2"),
+        ]
+        self.assertIn("4 messages copied", self.backfill(chunk_size=2))
+
+        conversation = Conversation.objects.get(user1=self.alice, user2=self.bob)
+        self.assertEqual(
+            list(conversation.messages.order_by('seq').values_list('seq', 'text', 'legacy_id')),
+            [(1, "a1", rows[0].id), (2, "b1", rows[1].id), (3, "a2", rows[3].id)]
+        )
+        # Send times are the legacy ones, not the copy's
+        self.assertEqual(conversation.messages.get(seq=1).timestamp, rows[0].timestamp)
+
+        self.assertEqual(conversation.last_seq, 3)
+        # Alice sent a2; Bob sent b1 and had read a1
+        self.assertEqual((conversation.user1_read_seq, conversation.user2_read_seq), (3, 2))
+        self.assertEqual((conversation.last_message, conversation.last_message_sender_id), ("a2", self.alice.id))
+        self.assertEqual(
+            set(conversation.inbox_entries.values_list('user_id', 'last_activity')),
+            {(self.alice.id, rows[3].timestamp), (self.bob.id, rows[3].timestamp)}
+        )
+        for user in (self.alice, self.bob, self.carol):
+            self.assertEqual(stored_total(user), UnreadCounter.count_for_user(user.id), user.email)
+        self.assertEqual(stored_total(self.bob), 1)
+
+    def test_rerun_copies_nothing_and_resumes_after_the_highest_seq(self):
+        for index in range(3):
+            self.legacy(self.alice, self.bob, f"m{index}")
+        self.backfill()
+        self.assertIn("0 messages copied", self.backfill())
+
+        conversation = Conversation.objects.get(user1=self.alice, user2=self.bob)
+        conversation.messages.filter(seq=1).delete()
+        self.legacy(self.bob, self.alice, "m3")
+        self.assertIn("1 messages copied", self.backfill())
+
+        self.assertEqual(
+            list(conversation.messages.order_by('seq').values_list('seq', 'text')),
+            [(2, "m1"), (3, "m2"), (4, "m3")]
+        )
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.last_seq, 4)
+
+    def test_history_never_reuses_the_seqs_of_live_messages(self):
+        conversation, _ = Conversation.get_or_create_direct(self.alice, self.bob)
+        row = self.legacy(self.alice, self.bob, "old")
+        live = Message.objects.create(conversation=conversation, sender=self.bob, text="live")
+        PersonalMessage.objects.filter(id=row.id).update(timestamp=live.timestamp - timedelta(days=1))
+
+        self.backfill()
+
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.last_message, "live")
+        # Seq 1 is taken by the live message, so the history goes after it
+        self.assertEqual(conversation.last_seq, 2)
+        self.assertEqual(conversation.messages.get(legacy_id=row.id).seq, 2)
+        for user in (self.alice, self.bob):
+            self.assertEqual(stored_total(user), UnreadCounter.count_for_user(user.id), user.email)
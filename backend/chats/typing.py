@@ -0,0 +1,138 @@
+"""
+Server-side coalescing of typing indicators.
+
+Clients send ``typing_start`` on (nearly) every keystroke. Instead of
+fanning each one out, sockets report to the coalescer bound to their event
+loop, which keeps per-conversation typing state and, at most once per
+``CHAT_TYPING_INTERVAL``, sends one ``typing_state`` event per changed
+conversation:
+
+    {"typing": [{"user_id", "user_name"}], "stopped": [user_id, ...]}
+
+Repeated starts only extend the typist's deadline; a typist with no start
+for ``CHAT_TYPING_TIMEOUT`` is stopped automatically; active typists are
+re-announced every half timeout so clients can expire entries on their
+own. Fan-out therefore grows with the interval, not the keystroke rate.
+Each process reports only its own sockets' typists, so frames are deltas
+that clients merge rather than replace.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .context import conversation_group_name
+from .db import per_loop
+from .frames import encode
+
+logger = logging.getLogger(__name__)
+
+
+class Typist:
+    __slots__ = ("user_name", "expires_at", "announced_at")
+
+    def __init__(self, user_name, expires_at):
+        self.user_name = user_name
+        self.expires_at = expires_at
+        self.announced_at = None
+
+
+class TypingCoalescer:
+
+    def __init__(self, interval=None, timeout=None):
+        self.interval = (
+            interval if interval is not None
+            else getattr(settings, "CHAT_TYPING_INTERVAL", 0.5)
+        )
+        self.timeout = (
+            timeout if timeout is not None
+            else getattr(settings, "CHAT_TYPING_TIMEOUT", 5.0)
+        )
+        # conversation id -> {user id: Typist}
+        self.typists = defaultdict(dict)
+        # conversation id -> user ids that stopped since the last flush
+        self.stopped = defaultdict(set)
+        self.changed = set()
+        self._task = None
+
+    def start(self, conversation_id, user_id, user_name):
+        deadline = asyncio.get_running_loop().time() + self.timeout
+        typist = self.typists[conversation_id].get(user_id)
+        if typist is not None:
+            # Already announced (or about to be): just keep it alive
+            typist.expires_at = deadline
+            return
+
+        self.typists[conversation_id][user_id] = Typist(user_name, deadline)
+        self.stopped[conversation_id].discard(user_id)
+        self.changed.add(conversation_id)
+        self._ensure_running()
+
+    def stop(self, conversation_id, user_id):
+        typists = self.typists.get(conversation_id)
+        if typists is None or typists.pop(user_id, None) is None:
+            return
+        self.stopped[conversation_id].add(user_id)
+        self.changed.add(conversation_id)
+        self._ensure_running()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        # Runs while anyone is typing; start()/stop() restart it
+        while self.typists or self.changed:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing typing state: {str(e)}")
+
+    async def flush(self):
+        now = asyncio.get_running_loop().time()
+
+        for conversation_id, typists in self.typists.items():
+            for user_id, typist in list(typists.items()):
+                if typist.expires_at <= now:
+                    del typists[user_id]
+                    self.stopped[conversation_id].add(user_id)
+                    self.changed.add(conversation_id)
+                elif typist.announced_at is None or now - typist.announced_at >= self.timeout / 2:
+                    self.changed.add(conversation_id)
+
+        changed, self.changed = self.changed, set()
+        channel_layer = get_channel_layer()
+        for conversation_id in changed:
+            typists = self.typists.get(conversation_id, {})
+            for typist in typists.values():
+                typist.announced_at = now
+
+            await channel_layer.group_send(
+                conversation_group_name(conversation_id),
+                {
+                    "type": "typing_state",
+                    "conversation_id": conversation_id,
+                    "frame": encode({
+                        "type": "typing_state",
+                        "conversation_id": conversation_id,
+                        "typing": [
+                            {"user_id": user_id, "user_name": typist.user_name}
+                            for user_id, typist in typists.items()
+                        ],
+                        "stopped": sorted(self.stopped.pop(conversation_id, ())),
+                        "timeout": self.timeout
+                    })
+                }
+            )
+            if not typists:
+                self.typists.pop(conversation_id, None)
+
+
+@per_loop
+def get_typing_coalescer():
+    """Return the coalescer bound to the running event loop."""
+    return TypingCoalescer()
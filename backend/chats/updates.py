@@ -0,0 +1,99 @@
+"""
+Inbox updates pushed to each user's ``user_{id}`` channel group.
+
+Every authenticated socket joins its user's group, so badges and inbox
+order stay current without polling. An update is a compact delta for one
+conversation: the new preview, the user's unread count there and their
+new total. Writers build the deltas after their transaction commits:
+
+    schedule_inbox_updates(conversation_id)            # from sync code
+    await push_inbox_updates([conversation_id], [uid]) # from consumers
+"""
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from .context import user_group_name
+from .db import db_task
+from .frames import encode
+from .models import Conversation, GroupParticipant, UnreadCounter
+
+
+def build_inbox_updates(conversation_ids, user_ids=None):
+    """
+    Return ``(user_id, event)`` pairs for the members of ``conversation_ids``
+    (only ``user_ids`` if given). Three queries regardless of group size.
+    """
+    conversations = Conversation.objects.filter(id__in=conversation_ids).values(
+        'id', 'conversation_type', 'user1_id', 'user2_id', 'last_seq',
+        'user1_read_seq', 'user2_read_seq',
+        'last_message', 'last_message_time', 'last_message_sender_id'
+    )
+
+    unread = []
+    group_ids = []
+    for conversation in conversations:
+        if conversation['conversation_type'] == 'direct':
+            for user_id, read_seq in (
+                (conversation['user1_id'], conversation['user1_read_seq']),
+                (conversation['user2_id'], conversation['user2_read_seq']),
+            ):
+                unread.append((conversation, user_id, conversation['last_seq'] - read_seq))
+        else:
+            group_ids.append(conversation['id'])
+
+    if group_ids:
+        by_id = {conversation['id']: conversation for conversation in conversations}
+        participants = GroupParticipant.objects.filter(conversation_id__in=group_ids)
+        if user_ids is not None:
+            participants = participants.filter(user_id__in=user_ids)
+        for conversation_id, user_id, read_seq in participants.values_list(
+            'conversation_id', 'user_id', 'last_read_seq'
+        ):
+            conversation = by_id[conversation_id]
+            unread.append((conversation, user_id, conversation['last_seq'] - read_seq))
+
+    if user_ids is not None:
+        unread = [row for row in unread if row[1] in user_ids]
+
+    totals = dict(
+        UnreadCounter.objects.filter(
+            user_id__in={user_id for _, user_id, _ in unread}
+        ).values_list('user_id', 'total')
+    )
+
+    # Encoded once per user: every device of the user gets the same frame
+    return [
+        (user_id, {
+            "type": "inbox_update",
+            "conversation_id": conversation['id'],
+            "frame": encode({
+                "type": "inbox_update",
+                "conversation_id": conversation['id'],
+                "conversation_type": conversation['conversation_type'],
+                "last_message": conversation['last_message'],
+                "last_message_time": str(conversation['last_message_time']),
+                "last_message_sender_id": conversation['last_message_sender_id'],
+                "unread_count": unread_count,
+                "total_unread": max(totals.get(user_id, 0), 0),
+            })
+        })
+        for conversation, user_id, unread_count in unread
+        if user_id is not None
+    ]
+
+
+async def push_inbox_updates(conversation_ids, user_ids=None):
+    updates = await db_task(build_inbox_updates)(conversation_ids, user_ids)
+
+    channel_layer = get_channel_layer()
+    for user_id, event in updates:
+        await channel_layer.group_send(user_group_name(user_id), event)
+
+
+def schedule_inbox_updates(conversation_id, user_ids=None):
+    """From sync code: push the updates once the current transaction commits."""
+    transaction.on_commit(
+        lambda: async_to_sync(push_inbox_updates)([conversation_id], user_ids)
+    )
@@ -1,20 +1,31 @@
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db.models import Q, F, Case, When, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.db import transaction
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
+from rest_framework.exceptions import Throttled
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
 from rest_framework.pagination import PageNumberPagination
-
-from .models import Conversation, Message, PersonalMessage
+from .pagination import MessageCursorPagination, InboxCursorPagination
+
+from .models import Conversation, Message, GroupParticipant, InboxEntry, UnreadCounter
+from .context import notify_membership_changed
+from .updates import schedule_inbox_updates
+from .outbox import wake_dispatchers
+from .db import write_transaction
+from . import membership, metrics, ratelimit
+from .receipts import read_counts, readers_of
 from .serializers import (
     UserGetSerializer,
     MessageSerializer,
     ConversationSerializer,
     ConversationListSerializer
-    ,PersonalMessageSerializer
+    ,DirectMessageSerializer
+    ,InboxEntrySerializer
+    ,online_context
 )
 
 User = get_user_model()
@@ -84,9 +95,11 @@ def my_conversation_users(request):
         'user1','user2',"last_message_sender"
     ).order_by('-last_message_time')
 
-    serializer= ConversationListSerializer(conversations,many=True,context={
-        'request':request
-    })
+    context = online_context({'request': request}, [
+        convo.user2_id if convo.user1_id == user.id else convo.user1_id
+        for convo in conversations
+    ])
+    serializer= ConversationListSerializer(conversations,many=True,context=context)
 
     return Response(serializer.data)
 
@@ -104,6 +117,10 @@ def get_chats(request):
     ).select_related('user1', 'user2').order_by('-last_message_time')
 
     data = []
+    context = online_context({}, [
+        user_id for convo in conversations
+        for user_id in (convo.user1_id, convo.user2_id)
+    ])
 
     for convo in conversations:
         other_user = (
@@ -111,15 +128,11 @@ def get_chats(request):
             else convo.user1
         )
 
-        unread_count = (
-            convo.unread_count_user1
-            if convo.user1 == request.user
-            else convo.unread_count_user2
-        )
+        unread_count = convo.get_unread_count_for_user(request.user)
 
         data.append({
             "conversation_id": convo.id,
-            "user": UserGetSerializer(other_user).data,
+            "user": UserGetSerializer(other_user, context=context).data,
             "last_message": convo.last_message,
             "last_message_time": convo.last_message_time,
             "unread_count": unread_count
@@ -128,6 +141,45 @@ def get_chats(request):
     return Response(data)
 
 
+# --------------------------------------------------
+# Inbox (direct and group conversations, most recent first)
+# --------------------------------------------------
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def inbox(request):
+    user = request.user
+
+    group_read_seq = GroupParticipant.objects.filter(
+        conversation=OuterRef('conversation'),
+        user=user
+    ).values('last_read_seq')[:1]
+
+    # One indexed query: entries, conversation, peer and unread count together
+    entries = InboxEntry.objects.filter(user=user).select_related(
+        'conversation', 'peer'
+    ).annotate(
+        unread_count=Case(
+            When(
+                conversation__conversation_type='group',
+                then=F('conversation__last_seq') - Coalesce(Subquery(group_read_seq), F('conversation__last_seq'))
+            ),
+            When(
+                conversation__user1=user,
+                then=F('conversation__last_seq') - F('conversation__user1_read_seq')
+            ),
+            default=F('conversation__last_seq') - F('conversation__user2_read_seq'),
+        )
+    )
+
+    paginator = InboxCursorPagination()
+    page = paginator.paginate_queryset(entries, request)
+
+    context = online_context({}, [entry.peer_id for entry in page if entry.peer_id])
+    serializer = InboxEntrySerializer(page, many=True, context=context)
+    return paginator.get_paginated_response(serializer.data)
+
+
 # --------------------------------------------------
 # Get or Create Conversation
 # --------------------------------------------------
@@ -182,14 +234,17 @@ def get_conversation_messages_direct(request, conversation_id):
         return Response({"error": "Permission denied"}, status=403)
 
 
-    # For direct conversations we store messages in PersonalMessage
-    messages = PersonalMessage.objects.filter(
-        (Q(sender=conversation.user1) & Q(receiver=conversation.user2)) |
-        (Q(sender=conversation.user2) & Q(receiver=conversation.user1))
-    ).order_by('timestamp')
+    # Keyset page over the (conversation, -timestamp) index
+    paginator = MessageCursorPagination()
+    messages = paginator.paginate_queryset(
+        conversation.messages.select_related(
+            'sender', 'conversation__user1', 'conversation__user2'
+        ),
+        request
+    )
 
-    serializer = PersonalMessageSerializer(messages, many=True)
-    return Response(serializer.data)
+    serializer = DirectMessageSerializer(messages, many=True)
+    return paginator.get_paginated_response(serializer.data)
 
 
 # --------------------------------------------------
@@ -198,7 +253,8 @@ def get_conversation_messages_direct(request, conversation_id):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
-@transaction.atomic
+@throttle_classes([ratelimit.MessageRateThrottle])
+@write_transaction()
 def send_message_direct(request, user_id):
     try:
         receiver = User.objects.get(id=user_id)
@@ -225,21 +281,20 @@ def send_message_direct(request, user_id):
     # Get or create conversation (keeps conversation metadata)
     conversation, _ = Conversation.get_or_create_direct(request.user, receiver)
 
-    # Create personal (direct) message
-    message = PersonalMessage.objects.create(
+    wait = ratelimit.take("new_message", conversation_id=conversation.id)
+    if wait is not None:
+        raise Throttled(wait=wait)
+
+    # Message.save() assigns the sequence number and updates the conversation
+    message = Message.objects.create(
+        conversation=conversation,
         sender=request.user,
-        receiver=receiver,
-        message=message_text
+        text=message_text
     )
+    transaction.on_commit(wake_dispatchers)
+    schedule_inbox_updates(conversation.id)
 
-    # Update conversation metadata to reflect last message
-    conversation.last_message = message_text
-    conversation.last_message_time = message.timestamp
-    conversation.last_message_sender = request.user
-    conversation.increment_unread_for_receiver(request.user)
-    conversation.save()
-
-    serializer = PersonalMessageSerializer(message)
+    serializer = DirectMessageSerializer(message)
     return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
@@ -265,25 +320,13 @@ def mark_conversation_read(request, conversation_id):
             status=status.HTTP_403_FORBIDDEN
         )
 
-    other_user = (
-        conversation.user2
-        if request.user == conversation.user1
-        else conversation.user1
-    )
-
-    # Mark PersonalMessage instances between the two users as read
-    updated = PersonalMessage.objects.filter(
-        sender=other_user,
-        receiver=request.user,
+    # Mark the other user's messages as read
+    updated = conversation.messages.filter(
         is_read=False
-    ).update(is_read=True)
+    ).exclude(sender=request.user).update(is_read=True)
 
-    if request.user == conversation.user1:
-        conversation.unread_count_user1 = 0
-    else:
-        conversation.unread_count_user2 = 0
-
-    conversation.save()
+    conversation.reset_unread_for_user(request.user)
+    schedule_inbox_updates(conversation.id, [request.user.id])
 
     return Response({"marked_read": updated})
 
@@ -296,17 +339,8 @@ def mark_conversation_read(request, conversation_id):
 @permission_classes([IsAuthenticated])
 def unread_count(request):
 
-    conversations = Conversation.objects.filter(
-        Q(user1=request.user) | Q(user2=request.user)
-    )
-
-    total_unread = 0
-
-    for convo in conversations:
-        if convo.user1 == request.user:
-            total_unread += convo.unread_count_user1
-        else:
-            total_unread += convo.unread_count_user2
+    # Direct and group conversations; maintained on write, read from cache
+    total_unread = UnreadCounter.get_total(request.user.id)
 
     return Response({"unread_count": total_unread})
 
@@ -319,11 +353,12 @@ def unread_count(request):
 @permission_classes([IsAuthenticated])
 def delete_message(request, message_id):
     try:
-        message = PersonalMessage.objects.get(
+        message = Message.objects.get(
             id=message_id,
-            sender=request.user
+            sender=request.user,
+            conversation__conversation_type='direct'
         )
-    except PersonalMessage.DoesNotExist:
+    except Message.DoesNotExist:
         return Response({"error": "Message not found or permission denied"}, status=status.HTTP_404_NOT_FOUND)
 
     message.delete()
@@ -337,6 +372,7 @@ def delete_message(request, message_id):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@write_transaction()
 def create_group(request):
     name = request.data.get('name', '').strip()
     participant_ids = request.data.get('participants', [])
@@ -371,6 +407,8 @@ def create_group(request):
     # Add all participants
     conversation.participants.set(participants)
     conversation.save()
+    conversation.sync_group_participants()
+    membership.invalidate(conversation.id)
 
     serializer = ConversationSerializer(conversation, context={'request': request})
     return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -382,6 +420,7 @@ def create_group(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@write_transaction()
 def add_group_participants(request, conversation_id):
     try:
         conversation = Conversation.objects.get(
@@ -402,6 +441,9 @@ def add_group_participants(request, conversation_id):
     
     new_participants = User.objects.filter(id__in=participant_ids)
     conversation.participants.add(*new_participants)
+    conversation.sync_group_participants()
+    membership.invalidate(conversation.id)
+    notify_membership_changed(conversation.id)
     
     serializer = ConversationSerializer(conversation, context={'request': request})
     return Response(serializer.data)
@@ -413,6 +455,7 @@ def add_group_participants(request, conversation_id):
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
+@write_transaction()
 def remove_group_participant(request, conversation_id, user_id):
     """Remove a user from a group chat"""
     try:
@@ -430,6 +473,9 @@ def remove_group_participant(request, conversation_id, user_id):
     try:
         user_to_remove = User.objects.get(id=user_id)
         conversation.participants.remove(user_to_remove)
+        conversation.sync_group_participants()
+        membership.invalidate(conversation.id)
+        notify_membership_changed(conversation.id)
         return Response({"message": "User removed from group"})
     except User.DoesNotExist:
         return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -441,6 +487,7 @@ def remove_group_participant(request, conversation_id, user_id):
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
+@write_transaction()
 def delete_group(request,conversation_id):
     try:
         group= Conversation.objects.get(id=conversation_id)
@@ -450,7 +497,11 @@ def delete_group(request,conversation_id):
     if group.created_by !=request.user:
         return Response({"error":"Only the Group creator can delete this group"},status=status.HTTP_403_FORBIDDEN)
     
+    member_ids = list(group.inbox_entries.values_list('user_id', flat=True))
     group.delete()
+    UnreadCounter.recount(member_ids)
+    membership.invalidate(conversation_id)
+    notify_membership_changed(conversation_id)
     return Response({"message":"Group Has been deleted"},status=status.HTTP_200_OK)
 
 
@@ -461,16 +512,23 @@ def delete_group(request,conversation_id):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def user_groups(request):
+    read_seq = GroupParticipant.objects.filter(
+        conversation=OuterRef('pk'),
+        user=request.user
+    ).values('last_read_seq')[:1]
+
     groups = Conversation.objects.filter(
         conversation_type='group',
         participants=request.user
+    ).annotate(
+        unread=F('last_seq') - Coalesce(Subquery(read_seq), F('last_seq'))
     ).order_by('-last_message_time')
 
     data = []
 
     for group in groups:
 
-        unread = group.get_group_unread_count(request.user)
+        unread = group.unread
 
         data.append({
             "conversation_id": group.id,
@@ -487,7 +545,8 @@ def user_groups(request):
 # --------------------------------------------------
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
-@transaction.atomic
+@throttle_classes([ratelimit.MessageRateThrottle])
+@write_transaction()
 def send_group_message(request,conversation_id):
         
     conversation = get_object_or_404(
@@ -496,7 +555,7 @@ def send_group_message(request,conversation_id):
         conversation_type='group'
     )
     
-    if request.user not in conversation.participants.all():
+    if not membership.is_member(request.user.id, conversation.id):
         return Response({"error":"Not a group member"},status=403)
     
     text = request.data.get("message","").strip()
@@ -504,18 +563,18 @@ def send_group_message(request,conversation_id):
     if not text:
         return Response({"error":"Message cant be empty"},status=400)
 
+    wait = ratelimit.take("new_message", conversation_id=conversation.id)
+    if wait is not None:
+        raise Throttled(wait=wait)
+
+    # Message.save() assigns the sequence number and updates the conversation
     message= Message.objects.create(
         conversation=conversation,
         sender=request.user,
         text=text
     )
-
-    conversation.last_message=text
-    conversation.last_message_time=message.timestamp
-    conversation.last_message_sender=request.user
-
-    conversation.increment_group_unread_for_all(request.user)
-    conversation.save()
+    transaction.on_commit(wake_dispatchers)
+    schedule_inbox_updates(conversation.id)
 
     serializer=MessageSerializer(message)
     return Response(serializer.data,status=201)
@@ -532,12 +591,34 @@ def get_group_message(request,conversation_id):
         id=conversation_id,
         conversation_type='group'
     )
-    if request.user not in conversation.participants.all():
+    if not membership.is_member(request.user.id, conversation.id):
         return Response({"error":"Not a group member"},status=403)
     
-    messages=conversation.messages.order_by('timestamp')
+    paginator=MessageCursorPagination()
+    messages=paginator.paginate_queryset(conversation.messages.select_related('sender'),request)
 
-    serializer=MessageSerializer(messages,many=True)
+    serializer=MessageSerializer(messages,many=True,context={
+        'read_counts': read_counts(conversation.id, messages)
+    })
+    return paginator.get_paginated_response(serializer.data)
+
+
+# --------------------------------------------------
+# Readers of a group message
+# --------------------------------------------------
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def get_group_message_readers(request,message_id):
+    message = get_object_or_404(
+        Message,
+        id=message_id,
+        conversation__conversation_type='group'
+    )
+    if not membership.is_member(request.user.id, message.conversation_id):
+        return Response({"error":"Not a group member"},status=403)
+
+    serializer=UserGetSerializer(readers_of(message),many=True)
     return Response(serializer.data)
 
 # --------------------------------------------------
@@ -575,9 +656,21 @@ def mark_group_read(request,conversation_id):
     except Conversation.DoesNotExist:
         return Response({"error":"Group Not found"},status=404)
     
-    if request.user not in conversation.participants.all():
+    if not membership.is_member(request.user.id, conversation.id):
         return Response({"error": "Not a group member"}, status=403)
 
     conversation.reset_group_unread_for_user(request.user)
+    schedule_inbox_updates(conversation.id, [request.user.id])
+
+    return Response({"message":"marked as read"})
+
+# --------------------------------------------------
+# Realtime metrics (this worker only)
+# --------------------------------------------------
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def metrics_snapshot(request):
+    if not request.user.is_superuser:
+        return Response({"error": "Permission denied"}, status=403)
 
-    return Response({"message":"marked as read"})
\ No newline at end of file
+    return Response(metrics.snapshot())
@@ -0,0 +1,198 @@
+"""
+Group-commit writer for messages sent over WebSocket.
+
+Consumers hand each incoming message to the writer and await a future.
+The writer collects messages for a few milliseconds, then persists the
+whole batch in one transaction: bulk inserts for the messages, one sequence
+reservation and one metadata update per conversation, and one unread-counter
+update for the whole batch, instead of per frame.
+
+Rows are locked in a fixed order so that concurrent batches (other workers,
+or REST sends) cannot deadlock: conversations by id, then the unread
+counters by user id.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+
+from .db import db_task, per_loop, write_transaction
+from .models import Conversation, Message, OutboxEvent, UnreadCounter
+from .outbox import get_outbox_dispatcher
+from .updates import push_inbox_updates
+
+logger = logging.getLogger(__name__)
+
+
+class PendingMessage:
+    __slots__ = ("sender", "conversation_id", "text", "future")
+
+    def __init__(self, sender, conversation_id, text, future):
+        self.sender = sender
+        self.conversation_id = conversation_id
+        self.text = text
+        self.future = future
+
+
+class MessageWriter:
+
+    def __init__(self, batch_window=None, max_batch_size=None):
+        self.batch_window = (
+            batch_window if batch_window is not None
+            else getattr(settings, "CHAT_WRITE_BATCH_WINDOW", 0.005)
+        )
+        self.max_batch_size = (
+            max_batch_size if max_batch_size is not None
+            else getattr(settings, "CHAT_WRITE_BATCH_MAX_SIZE", 200)
+        )
+        self.queue = asyncio.Queue()
+        self._task = None
+        # Inbox pushes in flight (kept referenced until they finish)
+        self._pushes = set()
+
+    async def submit(self, sender, conversation_id, text):
+        """
+        Queue a message for the next batch and wait for it to be committed.
+
+        Resolves to the saved message (with ``id`` and ``timestamp`` set),
+        or None if the conversation does not exist.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(PendingMessage(sender, conversation_id, text, future))
+        self._ensure_running()
+        return await future
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.batch_window
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Whatever arrived while we were waiting rides along for free
+        while len(batch) < self.max_batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            try:
+                results = await db_task(persist_batch)(batch)
+            except Exception as e:
+                logger.error(f"Error persisting batch of {len(batch)} messages: {str(e)}")
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                continue
+
+            for pending, result in zip(batch, results):
+                if not pending.future.done():
+                    pending.future.set_result(result)
+
+            get_outbox_dispatcher().wake()
+
+            # One inbox update per member per conversation in the batch,
+            # sent off the write path
+            conversation_ids = {result.conversation_id for result in results if result}
+            if conversation_ids:
+                push = asyncio.get_running_loop().create_task(self._push_updates(conversation_ids))
+                self._pushes.add(push)
+                push.add_done_callback(self._pushes.discard)
+
+    async def _push_updates(self, conversation_ids):
+        try:
+            await push_inbox_updates(conversation_ids)
+        except Exception as e:
+            logger.error(f"Error pushing inbox updates: {str(e)}")
+
+
+def persist_batch(batch):
+    """
+    Write a batch of pending messages in a single transaction.
+
+    Returns the saved message (or None) for each pending entry, in order.
+    """
+    results = [None] * len(batch)
+
+    with write_transaction():
+        conversations = Conversation.objects.in_bulk(
+            {pending.conversation_id for pending in batch}
+        )
+
+        by_conversation = defaultdict(list)
+        for index, pending in enumerate(batch):
+            if pending.conversation_id not in conversations:
+                logger.error(f"Conversation {pending.conversation_id} not found when saving message")
+                continue
+            by_conversation[pending.conversation_id].append(index)
+
+        messages = []
+        for conversation_id in sorted(by_conversation):
+            indexes = by_conversation[conversation_id]
+            conversation = conversations[conversation_id]
+            # One sequence reservation per conversation for the whole batch
+            first_seq = conversation.allocate_seqs(len(indexes))
+
+            for offset, index in enumerate(indexes):
+                pending = batch[index]
+                message = Message(
+                    conversation=conversation,
+                    sender=pending.sender,
+                    text=pending.text,
+                    seq=first_seq + offset
+                )
+                messages.append(message)
+                results[index] = message
+
+        # bulk_create skips Message.save(), so conversation metadata is
+        # written once per conversation below instead of once per message
+        Message.objects.bulk_create(messages)
+        # Fan-out events commit (or roll back) together with the messages
+        OutboxEvent.objects.bulk_create([OutboxEvent.for_message(message) for message in messages])
+
+        for conversation_id in sorted(by_conversation):
+            indexes = by_conversation[conversation_id]
+            conversation = conversations[conversation_id]
+
+            # Each sender has read up to their own newest message in the batch
+            senders = {}
+            for index in indexes:
+                senders[batch[index].sender.id] = (batch[index].sender, results[index].seq)
+
+            last = indexes[-1]
+            for sender_id, (sender, seq) in senders.items():
+                if sender_id != batch[last].sender.id:
+                    conversation.advance_read_seq(sender, seq)
+            conversation.record_last_message(
+                batch[last].sender,
+                batch[last].text,
+                results[last].timestamp,
+                results[last].seq
+            )
+
+        UnreadCounter.add_many({
+            conversations[conversation_id]: len(indexes)
+            for conversation_id, indexes in by_conversation.items()
+        })
+
+    return results
+
+
+@per_loop
+def get_message_writer():
+    """Return the writer bound to the running event loop."""
+    return MessageWriter()
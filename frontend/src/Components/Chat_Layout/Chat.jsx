@@ -6,7 +6,15 @@ function ChatWindow({ conversationId, otherUserId }) {
   console.log("other user id in ChatWindow:", otherUserId);
   const [messages, setMessages] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [hasOlder, setHasOlder] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const messagesEndRef = useRef(null);
+  const scrollRef = useRef(null);
+  // Set once older pages are loaded: polling then leaves hasOlder alone
+  const olderLoadedRef = useRef(false);
+  // scrollHeight before older messages were prepended, to keep the view still
+  const prependHeightRef = useRef(null);
+  const lastMessageIdRef = useRef(null);
 
   const getLoggedInUserId = () => {
     const token = document.cookie.split("token=")[1];
@@ -42,7 +50,16 @@ function ChatWindow({ conversationId, otherUserId }) {
           { headers: { Authorization: `Bearer ${token}` } }
         );
 
-        setMessages(res.data);
+        // The newest page replaces what it covers; older pages are kept
+        const newest = res.data.results;
+        setMessages((prev) =>
+          newest.length === 0
+            ? newest
+            : [...prev.filter((m) => m.id < newest[0].id), ...newest]
+        );
+        if (!olderLoadedRef.current) {
+          setHasOlder(res.data.older_cursor !== null);
+        }
       } catch (err) {
         console.error(err);
       } finally {
@@ -57,8 +74,45 @@ function ChatWindow({ conversationId, otherUserId }) {
     return () => clearInterval(intervalId);
   }, [conversationId]);
 
+  const loadOlder = async () => {
+    if (!hasOlder || loadingOlder || messages.length === 0) return;
+    setLoadingOlder(true);
+    try {
+      const token = document.cookie.split("token=")[1];
+      const res = await axios.get(
+        `http://127.0.0.1:8000/api/conversations/${conversationId}/messages/`,
+        {
+          params: { before: messages[0].id },
+          headers: { Authorization: `Bearer ${token}` },
+        }
+      );
+      olderLoadedRef.current = true;
+      prependHeightRef.current = scrollRef.current?.scrollHeight ?? null;
+      setMessages((prev) => [...res.data.results, ...prev]);
+      setHasOlder(res.data.older_cursor !== null);
+    } catch (err) {
+      console.error(err);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
+  const handleScroll = (e) => {
+    if (e.currentTarget.scrollTop === 0) loadOlder();
+  };
+
   useEffect(() => {
-    scrollToBottom();
+    if (prependHeightRef.current !== null && scrollRef.current) {
+      // Older messages went in above: stay on the message that was on top
+      scrollRef.current.scrollTop =
+        scrollRef.current.scrollHeight - prependHeightRef.current;
+      prependHeightRef.current = null;
+    }
+    const lastId = messages.length ? messages[messages.length - 1].id : null;
+    if (lastId !== lastMessageIdRef.current) {
+      lastMessageIdRef.current = lastId;
+      scrollToBottom();
+    }
   }, [messages]);
 
   const formatDate = (isoString) =>
@@ -70,6 +124,9 @@ function ChatWindow({ conversationId, otherUserId }) {
     });
   useEffect(() => {
     setLoading(true);
+    setMessages([]);
+    setHasOlder(false);
+    olderLoadedRef.current = false;
   }, [conversationId]);
 
   if (loading)
@@ -79,7 +136,20 @@ return (
   <div className="flex flex-col h-full">
 
     {/* 🔹 Messages Area */}
-    <div className="flex-1 p-4 space-y-2 overflow-y-auto">
+    <div
+      ref={scrollRef}
+      onScroll={handleScroll}
+      className="flex-1 p-4 space-y-2 overflow-y-auto"
+    >
+      {hasOlder && (
+        <button
+          onClick={loadOlder}
+          disabled={loadingOlder}
+          className="block mx-auto text-xs text-gray-500 hover:underline"
+        >
+          {loadingOlder ? "Loading older messages..." : "Load older messages"}
+        </button>
+      )}
 
       {messages.length === 0 ? (
         <p className="text-center mt-4 text-gray-500">
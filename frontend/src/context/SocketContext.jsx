@@ -3,6 +3,9 @@ import { useAuth } from './AuthContext';
 
 const SocketContext = createContext();
 
+// Well inside the server's CHAT_PRESENCE_TIMEOUT (60s)
+const HEARTBEAT_INTERVAL = 25000;
+
 export const useSocket = () => {
   const context = useContext(SocketContext);
   if (!context) throw new Error('useSocket must be used within SocketProvider');
@@ -17,6 +20,8 @@ export const SocketProvider = ({ children }) => {
   const socketRef = useRef(null);
   const messageIdsRef = useRef(new Set());
   const currentConversationRef = useRef(null);
+  const heartbeatRef = useRef(null);
+  const typingTimersRef = useRef({});
   const { token, user } = useAuth();
 
   const clearMessages = useCallback(() => {
@@ -98,6 +103,14 @@ export const SocketProvider = ({ children }) => {
       socketRef.current = ws;
       currentConversationRef.current = conversationId;
       markMessagesAsRead(conversationId);
+
+      // Keeps us online; the server closes sockets that stop heartbeating
+      clearInterval(heartbeatRef.current);
+      heartbeatRef.current = setInterval(() => {
+        if (ws.readyState === WebSocket.OPEN) {
+          ws.send(JSON.stringify({ type: 'heartbeat' }));
+        }
+      }, HEARTBEAT_INTERVAL);
     };
 
     // FIXED: Added the full message handling logic
@@ -152,30 +165,36 @@ export const SocketProvider = ({ children }) => {
             break;
             }
 
-            case 'typing':
-            console.log('⌨️ Typing event:', data);
-            if (data.status === 'start') {
-                setTypingUsers(prev => ({
-                ...prev,
-                [data.user_id]: data.user_name || 'Someone'
-                }));
-                
-                // Auto-clear typing after 3 seconds
-                setTimeout(() => {
-                setTypingUsers(prev => {
-                    const newState = { ...prev };
-                    delete newState[data.user_id];
-                    return newState;
-                });
-                }, 3000);
-            } else {
+            case 'typing_state': {
+            // Deltas: typists are re-announced while they type, so each
+            // entry expires unless it is repeated within the frame's timeout
+            console.log('⌨️ Typing state:', data);
+            const clearTypist = (userId) => {
+                clearTimeout(typingTimersRef.current[userId]);
+                delete typingTimersRef.current[userId];
                 setTypingUsers(prev => {
                 const newState = { ...prev };
-                delete newState[data.user_id];
+                delete newState[userId];
                 return newState;
                 });
-            }
+            };
+
+            data.stopped.forEach(clearTypist);
+            data.typing
+                .filter(typist => typist.user_id !== user?.id)
+                .forEach(typist => {
+                setTypingUsers(prev => ({
+                    ...prev,
+                    [typist.user_id]: typist.user_name || 'Someone'
+                }));
+                clearTimeout(typingTimersRef.current[typist.user_id]);
+                typingTimersRef.current[typist.user_id] = setTimeout(
+                    () => clearTypist(typist.user_id),
+                    data.timeout * 1000
+                );
+                });
             break;
+            }
 
             case 'read_receipt':
             console.log('👁️ Read receipt:', data);
@@ -186,6 +205,20 @@ export const SocketProvider = ({ children }) => {
             );
             break;
 
+            case 'presence':
+            setConversations(prev =>
+                prev.map(conv => {
+                const change = data.users.find(u => u.user_id === conv.user?.id);
+                return change
+                    ? { ...conv, user: { ...conv.user, is_online: change.is_online, last_seen: change.last_seen } }
+                    : conv;
+                })
+            );
+            break;
+
+            case 'heartbeat':
+            break;
+
             default:
             console.log('Unknown message type:', data);
         }
@@ -203,6 +236,10 @@ export const SocketProvider = ({ children }) => {
       });
       setIsConnected(false);
       socketRef.current = null;
+      clearInterval(heartbeatRef.current);
+      Object.values(typingTimersRef.current).forEach(clearTimeout);
+      typingTimersRef.current = {};
+      setTypingUsers({});
       
       if (currentConversationRef.current === conversationId) {
         currentConversationRef.current = null;
@@ -298,6 +335,8 @@ export const SocketProvider = ({ children }) => {
 
   useEffect(() => {
     return () => {
+      clearInterval(heartbeatRef.current);
+      Object.values(typingTimersRef.current).forEach(clearTimeout);
       if (socketRef.current) {
         socketRef.current.close();
       }